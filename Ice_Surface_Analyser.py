@@ -8,15 +8,126 @@ import pandas as pd
 import xarray as xr
 import ebmodel as ebm
 import ebmodel as ebm
-import glob
+import fnmatch
 import os
-import dask
+import rasterio
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import cKDTree
+from numba import njit, prange
 
 try:
     import joblib
 except ImportError:
     from sklearn.externals import joblib
 
+
+@njit(parallel=True)
+def _forest_predict(X, feature, threshold, left, right, proba, block=4096):
+    """ Evaluate a flattened random forest on a (pixels, bands) feature matrix.
+
+    Each tree is walked from the root until a leaf (left child == -1) is reached and the
+    leaf class probabilities are summed over all trees, matching sklearn's soft voting.
+    Returns the index of the winning class for each pixel.
+
+    """
+    n_samples = X.shape[0]
+    n_trees = feature.shape[0]
+    n_classes = proba.shape[2]
+    n_blocks = (n_samples + block - 1) // block
+    out = np.empty(n_samples, dtype=np.int32)
+
+    for b in prange(n_blocks):
+        votes = np.empty(n_classes)
+
+        for s in range(b * block, min((b + 1) * block, n_samples)):
+            votes[:] = 0.0
+
+            for t in range(n_trees):
+                node = 0
+                while left[t, node] != -1:
+                    if X[s, feature[t, node]] <= threshold[t, node]:
+                        node = left[t, node]
+                    else:
+                        node = right[t, node]
+
+                for c in range(n_classes):
+                    votes[c] += proba[t, node, c]
+
+            out[s] = np.argmax(votes)
+
+    return out
+
+
+def _thresholds_to_dn(threshold, scaling):
+    """ Rescale float tree thresholds to L2A digital numbers.
+
+    sklearn sees reflectance as float32(DN / scaling) and splits on float32(DN / scaling) <= threshold.
+    That reflectance is monotonic in DN, so the split is the same as DN <= the last DN whose float32
+    reflectance is <= threshold, which is found for every node with one search of all 65536 DNs.
+
+    """
+    reflectance = np.arange(65536, dtype=np.float32) / np.float32(scaling)
+
+    return (np.searchsorted(reflectance, threshold, side='right') - 1).astype(np.int32)
+
+
+@njit(parallel=True, fastmath=True)
+def _lut_nearest(lut_T, pixels, block=1024):
+    """ Brute-force nearest LUT spectrum for each pixel by summed absolute error.
+
+    The LUT is band-major (bands, spectra), so for each band the innermost loop runs
+    over contiguous spectra and compiles to SIMD subtract/abs/add. Returns the index of
+    the best matching spectrum for each pixel.
+
+    """
+    n_bands, n_spectra = lut_T.shape
+    n_samples = pixels.shape[0]
+    n_blocks = (n_samples + block - 1) // block
+    out = np.empty(n_samples, dtype=np.int64)
+
+    for b in prange(n_blocks):
+        err = np.empty(n_spectra, dtype=lut_T.dtype)
+
+        for s in range(b * block, min((b + 1) * block, n_samples)):
+            err[:] = 0
+
+            for j in range(n_bands):
+                pix = pixels[s, j]
+                for i in range(n_spectra):
+                    err[i] += abs(lut_T[j, i] - pix)
+
+            out[s] = np.argmin(err)
+
+    return out
+
+
+@njit(parallel=True)
+def _lut_nearest_q(lut_T, pixels, block=1024):
+    """ As _lut_nearest, but on LUT and pixel spectra quantized to uint8, with the summed
+    absolute error accumulated in int32.
+
+    """
+    n_bands, n_spectra = lut_T.shape
+    n_samples = pixels.shape[0]
+    n_blocks = (n_samples + block - 1) // block
+    out = np.empty(n_samples, dtype=np.int64)
+
+    for b in prange(n_blocks):
+        err = np.empty(n_spectra, dtype=np.int32)
+
+        for s in range(b * block, min((b + 1) * block, n_samples)):
+            err[:] = 0
+
+            for j in range(n_bands):
+                pix = np.int32(pixels[s, j])
+                for i in range(n_spectra):
+                    err[i] += abs(np.int32(lut_T[j, i]) - pix)
+
+            out[s] = np.argmin(err)
+
+    return out
+
+
 class SurfaceClassifier:
 
     # Bands to use in classifier
@@ -37,27 +148,156 @@ class SurfaceClassifier:
         :type pkl: str
 
         """
-        self.classifier = joblib.load(pkl)
+        self.forest = self.load_forest(pkl)
+
+        # the forest is evaluated on uint16 DN only once it has been checked to give the same labels as
+        # sklearn on float32 reflectance; otherwise it falls back to float32 reflectance and float thresholds
+        self.use_dn = bool(self.forest['dn_parity'])
+
+        if not self.use_dn:
+            print("WARNING: forest on L2A digital numbers disagrees with sklearn, classifying float32 reflectance")
+
+        # DISORT LUTs reduced to the S2 bands (KD-tree and band-major arrays), keyed by (coszen, band indexes)
+        # and filled on first use
+        self.luts = {}
+
+        # GDAL config options (e.g. /vsiaz/ credentials) applied to every rasterio read through rasterio.Env
+        self.gdal_options = {}
 
         return
 
 
+    def load_forest(self, pkl):
+        """ Flatten the trees of the pickled random forest into padded node arrays.
+
+        The arrays are cached as an .npz alongside the pickle so that later runs
+        can skip unpickling the classifier and the export. The cache is rebuilt
+        if the pickle is newer.
+
+        :param pkl: path of pickled classifier.
+        :type pkl: str
+
+        """
+        npz = os.path.splitext(pkl)[0] + '_forest.npz'
+
+        if os.path.exists(npz) and os.path.getmtime(npz) >= os.path.getmtime(pkl):
+            with np.load(npz) as cached:
+                # caches written before the DN parity check are rebuilt
+                if 'dn_parity' in cached.files:
+                    return {key: cached[key] for key in cached.files}
+
+        classifier = joblib.load(pkl)
+
+        # the classifier may be wrapped by sklearn_xarray, in which case the forest is the fitted estimator_
+        rf = getattr(classifier, 'estimator_', classifier)
+        trees = [est.tree_ for est in rf.estimators_]
+
+        n_trees = len(trees)
+        max_nodes = max(tree.node_count for tree in trees)
+        n_classes = len(rf.classes_)
+
+        feature = np.zeros((n_trees, max_nodes), dtype=np.int32)
+        threshold = np.zeros((n_trees, max_nodes), dtype=np.float64)
+        left = np.full((n_trees, max_nodes), -1, dtype=np.int32)
+        right = np.full((n_trees, max_nodes), -1, dtype=np.int32)
+        proba = np.zeros((n_trees, max_nodes, n_classes), dtype=np.float64)
+
+        for i, tree in enumerate(trees):
+            n = tree.node_count
+            feature[i, :n] = tree.feature
+            threshold[i, :n] = tree.threshold
+            left[i, :n] = tree.children_left
+            right[i, :n] = tree.children_right
+            value = tree.value[:, 0, :]
+            proba[i, :n] = value / value.sum(axis=1, keepdims=True)
+
+        forest = {'feature': feature, 'threshold': threshold, 'left': left, 'right': right,
+                  'proba': proba, 'classes': np.asarray(rf.classes_)}
+
+        # tree thresholds rescaled to L2A digital numbers so that the forest can be evaluated on uint16 reflectance
+        forest['threshold_dn'] = _thresholds_to_dn(threshold, self.l2a_scaling_factor)
+        forest['dn_parity'] = np.bool_(self.check_dn_parity(rf, forest))
+
+        np.savez(npz, **forest)
+
+        return forest
+
+
+
+    def check_dn_parity(self, rf, forest, n_pixels=100000, seed=0):
+        """ Check that the flattened forest on uint16 DN gives the same labels as sklearn on float32 reflectance.
+
+        Runs _forest_predict on a sample of DN pixels and rf.predict on the same pixels as float32
+        reflectance, as classify_image fed it before the DN path. Half of the pixels have one band set to
+        a DN either side of a split threshold, where rounding would show up first.
+
+        :param rf: fitted sklearn random forest.
+        :param forest: flattened forest from load_forest, including threshold_dn.
+
+        """
+        rng = np.random.RandomState(seed)
+        X = rng.randint(1, self.l2a_scaling_factor + 1, size=(n_pixels, len(self.s2_bands_use))).astype(np.uint16)
+
+        # internal nodes only: leaves have no split
+        tree, node = np.nonzero(forest['left'] != -1)
+        pick = rng.randint(0, len(tree), size=n_pixels // 2)
+        rows = np.arange(n_pixels // 2)
+        dn = forest['threshold_dn'][tree[pick], node[pick]] + rng.randint(0, 2, size=len(pick))
+        X[rows, forest['feature'][tree[pick], node[pick]]] = np.clip(dn, 0, 65535)
+
+        class_idx = _forest_predict(X, forest['feature'], forest['threshold_dn'],
+                                    forest['left'], forest['right'], forest['proba'])
 
-    def load_img_to_xr(self, img_path, resolution, Icemask, Cloudmask):
+        reflectance = X.astype(np.float32) / np.float32(self.l2a_scaling_factor)
+
+        return np.array_equal(forest['classes'][class_idx], rf.predict(reflectance))
+
+
+
+    def read_band(self, fn):
+        """ Read a single-band JP2000 into a float32 array and apply scaling factor.
+
+        :param fn: path of band image.
+        :type fn: str
+
+        """
+        with rasterio.Env(**self.gdal_options), rasterio.open(fn) as src:
+            return self._decode_band(src)
+
+
+
+    def _decode_band(self, src, out=None):
+        """ Read band 1 of an open rasterio dataset as float32 reflectance.
+
+        :param src: open rasterio dataset.
+        :param out: optional float32 array to scale the band into.
+
+        """
+        return np.divide(src.read(1), self.l2a_scaling_factor, out=out, dtype=np.float32)
+
+
+
+    def load_img_to_xr(self, img_files, resolution, Icemask, Cloudmask, preloaded=None):
         """ Load Sentinel-2 JP2000s into xr.Dataset.
 
-        Load all bands of image (specified by s2_bands_use) into an xarray
+        Load all bands of image (specified by s2_bands_use, found in the list of
+        local or /vsiaz/ paths img_files) into an xarray
         Dataset, include Icemask and Cloudmask, return the in-memory Dataset.
         Applies scaling factor.
 
+        :param preloaded: dict of {path: band array} for bands already read with
+            read_band (e.g. B02 for QC), which are reused rather than decoded again.
+
         """
-        
-        # Open link to each image
-        store = []
+
+        preloaded = preloaded or {}
+
+        # Find the file for each band
+        fns = []
 
         for band in self.s2_bands_use:
 
-            fn = glob.glob('%s*%s_%sm.jp2' %(img_path,band,resolution))
+            fn = fnmatch.filter(img_files, '*%s_%sm.jp2' %(band,resolution))
 
             if len(fn) > 1:
                 raise ValueError("Multiple bands named {} in blob container. One expected.".format(fn))
@@ -68,24 +308,54 @@ class SurfaceClassifier:
 
                 except:
                     raise IndexError("At least one band missing from S2 blob container")        
-            
-            da_band = xr.open_rasterio(fn, chunks={self.NAME_x: 2000, self.NAME_y: 2000})
-            crs = da_band.attrs['crs']
-            # Apply scaling factor
-            da_band = da_band / self.l2a_scaling_factor
-            da_band[self.NAME_bands] = band
-            store.append(da_band)
-        
-        # Concatenate all bands into a single DataArray
-        da = xr.concat(store, dim=self.NAME_bands).squeeze()
+
+            fns.append(fn)
+
+        # the masks are already on the bands' 20 m grid, so the cube can be allocated before any band is opened
+        ny, nx = np.shape(Icemask)
+
+        # Decode the bands in parallel. GDAL releases the GIL while decoding JP2s so threads scale with cores,
+        # and the whole tile fits in memory so the arrays are read eagerly rather than as dask chunks.
+        # Each band is scaled straight into its slot of one preallocated array, so there is no per-band
+        # float copy and no final stack/concat copy of the whole cube. The cube is laid out pixel-major
+        # (y, x, bands): the classifier, albedo and DISORT inversion all want one row of bands per pixel,
+        # so they can all use it as a (pixels, bands) view instead of each making its own transposed copy.
+        da = np.empty((ny, nx, len(fns)), dtype=np.float32)
+
+        def load_band(i):
+            if fns[i] in preloaded:
+                da[..., i] = preloaded[fns[i]]
+
+            else:
+                # rasterio.Env is per thread, so each worker enters its own
+                with rasterio.Env(**self.gdal_options), rasterio.open(fns[i]) as src:
+                    self._decode_band(src, out=da[..., i])
+
+                    # every band shares the grid, so each worker hands back the one it opened. This saves a
+                    # separate serial open (and, for /vsiaz/ paths, a round trip) just to read the header.
+                    return src.crs.to_proj4(), src.transform
+
+        with ThreadPoolExecutor(max_workers=len(fns)) as ex:
+            grids = [grid for grid in ex.map(load_band, range(len(fns))) if grid is not None]
+
+        if grids:
+            crs, transform = grids[0]
+
+        else:
+            with rasterio.Env(**self.gdal_options), rasterio.open(fns[0]) as src:
+                crs, transform = src.crs.to_proj4(), src.transform
+
+        # pixel-centre coordinates, as xr.open_rasterio would give
+        x = transform.c + transform.a * (np.arange(nx) + 0.5)
+        y = transform.f + transform.e * (np.arange(ny) + 0.5)
 
         # Create complete dataset
-        ds = xr.Dataset({ 'Data': ((self.NAME_bands,self.NAME_y,self.NAME_x), da),
+        ds = xr.Dataset({ 'Data': ((self.NAME_y,self.NAME_x,self.NAME_bands), da),
                           'Icemask': ((self.NAME_y,self.NAME_x), Icemask),
                           'Cloudmask': ((self.NAME_y,self.NAME_x), Cloudmask) },
                           coords={self.NAME_bands:self.s2_bands_use, 
-                                  self.NAME_y:da_band[self.NAME_y],
-                                  self.NAME_x:da_band[self.NAME_x]})
+                                  self.NAME_y:y,
+                                  self.NAME_x:x})
 
         ds.Data.attrs['crs'] = crs
 
@@ -93,26 +363,58 @@ class SurfaceClassifier:
 
 
     def classify_image(self, S2vals, savepath, tile, date, 
-        savefigs=True):
+        savefigs=True, block_rows=2000):
         """ Apply classifier to image.
 
         function applies pickled classifier to multispectral S2 image saved as
         NetCDF, saving plot and summary data to output folder.
+
+        The image is classified in strips of block_rows rows so the feature matrix
+        and masks only ever exist for one strip at a time, while the forest itself
+        is evaluated in parallel across all cores within each strip.
         """
 
-        # stack the values into a 1D array
-        stacked = S2vals.Data.stack(allpoints=[self.NAME_y,self.NAME_x])
+        ny = S2vals.sizes[self.NAME_y]
+        nx = S2vals.sizes[self.NAME_x]
+        n_bands = len(self.s2_bands_use)
+
+        # bands in the same order as the training data. Going straight to numpy avoids building the
+        # MultiIndex that stack/unstack would need.
+        data = S2vals.Data.transpose(self.NAME_y, self.NAME_x, self.NAME_bands).values
+        icemask = S2vals.Icemask.values
+        cloudmask = S2vals.Cloudmask.values
+
+        predicted = np.zeros((ny, nx), dtype=np.int8)
+
+        threshold = self.forest['threshold_dn'] if self.use_dn else self.forest['threshold']
+
+        for row in range(0, ny, block_rows):
+            strip = slice(row, row + block_rows)
+
+            # contiguous (pixels, bands) feature matrix for this strip. If the DN parity check passed,
+            # reflectance is quantized back to uint16 L2A digital numbers, halving the bytes the forest reads.
+            if self.use_dn:
+                X = np.rint(data[strip].reshape(-1, n_bands) * self.l2a_scaling_factor)
+                X = np.ascontiguousarray(X, dtype=np.uint16)
 
-        # Transpose and rename so that DataArray has exactly the same layout/labels as the training DataArray.
-        # mask out nan areas not masked out by GIMP
-        stackedT = stacked.T
-        stackedT = stackedT.rename({'allpoints': 'samples'})
+            else:
+                X = np.ascontiguousarray(data[strip].reshape(-1, n_bands), dtype=np.float32)
+
+            # only classify pixels that pass the ice, cloud and NaN masks - the rest are masked out afterwards
+            # anyway, so they are left as 0 rather than spending tree traversals on them
+            valid = (icemask[strip].ravel() == 1) \
+                & (cloudmask[strip].ravel() == 0) \
+                & (X[:, 0] > 0)
 
-        # apply classifier
-        predicted = self.classifier.predict(stackedT)
+            if valid.any():
+                class_idx = _forest_predict(X[valid], self.forest['feature'], threshold,
+                                            self.forest['left'], self.forest['right'], self.forest['proba'])
 
-        # Unstack back to x,y grid
-        predicted = predicted.unstack(dim='samples')
+                # predicted is C-contiguous so the strip reshapes to a writeable view
+                predicted[strip].reshape(-1)[valid] = self.forest['classes'][class_idx]
+
+        predicted = xr.DataArray(predicted, dims=(self.NAME_y, self.NAME_x),
+                                 coords={self.NAME_y: S2vals[self.NAME_y], self.NAME_x: S2vals[self.NAME_x]})
 
         return predicted
 
@@ -126,19 +428,27 @@ class SurfaceClassifier:
         See also Naegeli et al 2017, Remote Sensing
         """
         
-        albedo = (  0.356 * S2vals.Data.loc[{self.NAME_bands:'B02'}] \
-                  + 0.130 * S2vals.Data.loc[{self.NAME_bands:'B04'}] \
-                  + 0.373 * S2vals.Data.loc[{self.NAME_bands:'B8A'}] \
-                  + 0.085 * S2vals.Data.loc[{self.NAME_bands:'B11'}] \
-                  + 0.072 * S2vals.Data.loc[{self.NAME_bands:'B12'}] \
-                  - 0.0018 )
+        # narrowband-to-broadband coefficients laid out in band order so that albedo is one
+        # dot product over the band axis rather than five label lookups and adds
+        coeffs = {'B02': 0.356, 'B04': 0.130, 'B8A': 0.373, 'B11': 0.085, 'B12': 0.072}
+        coeffs = np.array([coeffs.get(band, 0) for band in S2vals[self.NAME_bands].values], dtype=np.float32)
+
+        data = S2vals.Data.transpose(self.NAME_y, self.NAME_x, self.NAME_bands).values
+
+        albedo = np.tensordot(data, coeffs, axes=1) - np.float32(0.0018)
+
+        albedo = xr.DataArray(albedo, dims=(self.NAME_y, self.NAME_x),
+                              coords={self.NAME_y: S2vals[self.NAME_y], self.NAME_x: S2vals[self.NAME_x]})
 
         return albedo
 
     def calculate_2DBA(self, S2vals):
 
         Index2DBA = S2vals.Data.loc[{self.NAME_bands:'B05'}]/S2vals.Data.loc[{self.NAME_bands:'B04'}]
-        predict2DBA = 10E-35 * Index2DBA * np.exp(87.015*Index2DBA)
+
+        # the band data is float32, where exp(87.015*Index2DBA) alone overflows once the index passes ~1.02,
+        # so the 10E-35 coefficient is folded into the exponent to keep the product in range
+        predict2DBA = Index2DBA * np.exp(87.015*Index2DBA + np.log(10E-35))
 
         return Index2DBA, predict2DBA
 
@@ -146,30 +456,32 @@ class SurfaceClassifier:
     def combine_masks(self, S2vals):
         """ Combine ice mask and cloud masks """
 
+        # no-data pixels are 0 in every band, so testing the first band is enough and avoids summing all nine
         mask2 = (S2vals.Icemask.values == 1)  \
-            & (S2vals.Data.sum(dim=self.NAME_bands) > 0) \
+            & (S2vals.Data.isel({self.NAME_bands: 0}).values > 0) \
             & (S2vals.Cloudmask.values == 0)
 
         return mask2
 
 
-    def invert_disort(self, S2vals, mask2, predictedxr, side_lengths, densities, algae, wavelengths, idx, tile, year, month):
+    def invert_disort(self, S2vals, mask2, predictedxr, side_lengths, densities, algae, wavelengths, idx, tile, date, year, month,
+        search='tree'):
         """
         Pixelwise retrieval of disort RT params by matching spectra against disort-generated LUT loaded from process_dir
+
+        :param search: 'tree' to query a KD-tree of the LUT, 'brute' to compare every pixel against
+            every LUT spectrum with a vectorised numba kernel, or 'quantized' to do the same on spectra
+            quantized to uint8 per band (approximate - near-ties may resolve differently)
         """
         
-        # stack the values into a 1D array
-        stacked = S2vals.Data.stack(allpoints=[self.NAME_y,self.NAME_x])
-
-        # Transpose and rename so that DataArray has exactly the same layout/labels as the training DataArray.
-        stackedT = stacked.T
-        stackedT = stackedT.rename({'allpoints': 'samples'})
-
-        # RECHUNK STACKEDT: choice of chunk size is crucial for maximising speed while preventing memory over-allocation.
-        # While 20000 seems small there are very large intermediate arrays spawned by the compute() function.
-        # chunks >~20000 give memory error due to size of intermediate arrays 
-        stackedT = stackedT.chunk(20000,9)
+        # flatten to a contiguous (pixels, bands) array. A plain transpose and reshape gives the same
+        # y-major pixel order as stack(allpoints=[y,x]) without building the MultiIndex.
+        # Only pixels inside the combined ice/cloud/NaN mask are matched against the LUT, since everything
+        # else is masked out of the result anyway.
+        valid = np.asarray(mask2).ravel() > 0
 
+        pixels = S2vals.Data.transpose(self.NAME_y, self.NAME_x, self.NAME_bands).values
+        pixels = np.ascontiguousarray(pixels.reshape(-1, S2vals.sizes[self.NAME_bands])[valid], dtype=np.float32)
 
         #################################
         # SELECT AND LOAD LUT
@@ -177,11 +489,7 @@ class SurfaceClassifier:
 
         # identify coszen and load appropriate lut
 
-        files = glob.glob(os.environ['PROCESS_DIR'] + '*.jp2') # grab current files
-        file = files[0] #take first file from list
-        print(file[52:60]) # print year,month and day from the filename
-    
-        rowID = file[52:60] # make the date info from the filename rowID
+        rowID = date # the date (yyyymmdd) identifies the image in the metadata file
 
         print(rowID)
         print(tile.upper())
@@ -203,81 +511,92 @@ class SurfaceClassifier:
 
         coszen = int(coszen*10) #round to nearest tenth
 
-        # load the LUT associated with the appropriate solar zenith angle
-        LUT = np.load(str(os.environ['PROCESS_DIR'] +'LUT_cz0{}.npy'.format(coszen)))
+        # load the LUT associated with the appropriate solar zenith angle. There are only a handful of
+        # zenith angles, so each LUT is read and reduced once and then reused for every later image.
+        lut_key = (coszen, tuple(idx))
+
+        if lut_key not in self.luts:
 
-        # reformat LUT: flatten LUT from 3D to 2D array with one column per combination
-        # of RT params, one row per wavelength
+            LUT = np.load(str(os.environ['PROCESS_DIR'] +'LUT_cz0{}.npy'.format(coszen)))
 
-        LUT = LUT.reshape(2244,len(wavelengths))
+            # reformat LUT: flatten LUT from 3D to 2D array with one column per combination
+            # of RT params, one row per wavelength
+            LUT = LUT.reshape(2244,len(wavelengths))
+
+            # reduce wavelengths to only the 9 that match the S2 image and index the spectra in a KD-tree.
+            # Querying the tree with the L1 (p=1) norm finds the same spectrum as the smallest mean absolute
+            # error, but visits only a few leaves per pixel instead of every one of the 2244 spectra.
+            # A band-major copy is kept for the brute-force kernel, along with a uint8 copy scaled to each
+            # band's range in the LUT for the quantized kernel, which streams a quarter of the bytes.
+            LUT = np.ascontiguousarray(LUT[:,idx], dtype=np.float32)
+            lut_min = LUT.min(axis=0)
+            lut_scale = 255 / np.maximum(LUT.max(axis=0) - lut_min, np.finfo(np.float32).eps)
+
+            self.luts[lut_key] = {'tree': cKDTree(LUT), 'lut_T': np.ascontiguousarray(LUT.T),
+                                  'lut_T_q': np.ascontiguousarray(np.rint((LUT - lut_min) * lut_scale).T, dtype=np.uint8),
+                                  'min': lut_min, 'scale': lut_scale}
+
+        LUT = self.luts[lut_key]
 
         ##################################
         ###################################
 
 
-        # find most similar LUT spectrum for each pixel in S2 image
-        # astype(float 16) to reduce memory allocation (default was float64)
-        LUT = LUT[:,idx] # reduce wavelengths to only the 9 that match the S2 image
+        # find most similar LUT spectrum for each pixel in S2 image, on all cores. Spectra at exactly equal
+        # distance resolve in tree order on the 'tree' path, not to the lowest LUT index as argmin would.
+        if search == 'tree':
+            # cKDTree.query's n_jobs was renamed workers in scipy 1.6 and the old name removed in 1.9
+            try:
+                _, idx_array = LUT['tree'].query(pixels, k=1, p=1, workers=-1)
 
-        LUT = xr.DataArray(LUT,dims=('spectrum','bands')).astype(np.float16)
+            except TypeError:
+                _, idx_array = LUT['tree'].query(pixels, k=1, p=1, n_jobs=-1)
 
-        error_array = LUT - stackedT.astype(np.float16)  # subtract reflectance from disort reflectance pixelwise
-        idx_array = xr.apply_ufunc(abs,error_array,dask='allowed')
-        idx_array = xr.apply_ufunc(np.mean,idx_array,input_core_dims=[['bands']],dask='allowed',kwargs={'axis':-1})
-        idx_array = xr.apply_ufunc(np.argmin,idx_array,input_core_dims=[['spectrum']],dask='allowed',kwargs={'axis':-1})
+        elif search == 'brute':
+            idx_array = _lut_nearest(LUT['lut_T'], pixels)
 
+        elif search == 'quantized':
+            # pixels are scaled with the LUT's per-band range; reflectance outside the range is clipped to it
+            pixels_q = np.clip(np.rint((pixels - LUT['min']) * LUT['scale']), 0, 255).astype(np.uint8)
+            idx_array = _lut_nearest_q(LUT['lut_T_q'], pixels_q)
+            pixels_q = None
 
-        # unravel index computes the index in the original n-dimeniona LUT from the index in the flattened LUT
-        @dask.delayed
-        def unravel(idx_array,densities,side_lengths,algae):
-            param_array = np.array(np.unravel_index(idx_array,[len(densities),len(side_lengths),len(algae)]))
-            return param_array
+        else:
+            raise ValueError("Unknown LUT search method {}, expected 'tree', 'brute' or 'quantized'".format(search))
 
-        param_array = unravel(idx_array,densities,side_lengths,algae)
-        param_array = np.array(param_array.compute())
+        # unravel index computes the index in the original n-dimeniona LUT from the index in the flattened LUT
+        param_array = np.array(np.unravel_index(idx_array,[len(densities),len(side_lengths),len(algae)]))
 
         # flush disk
         idx_array = None
-        error_array = None
-        dirtyLUT = None
 
         #use the indexes to retrieve the actual parameter values for each pixel from the LUT indexes
         # since the values are assumed equal in all vertical layers (side_lengths and density) or only the top layer (LAPs)
         # only the first value from the parameter arrays is needed.
 
-        counter = 0
-        param_names = ['densities','side_lengths','algae']
-        
-        for param in [densities, side_lengths, algae]:
-
-            for i in np.arange(0,len(param),1):
+        results = []
 
-                if i ==0: # in first loop, pixels !=i should be replaced by param_array values, as result_array doesn't exist yet
+        for counter, param in enumerate([densities, side_lengths, algae]):
 
-                    result_array = np.where(param_array[counter]==i, param[i][0], param_array[counter])
+            # map LUT indexes to parameter values with a single gather from a lookup table and
+            # scatter them back into the image, leaving masked pixels as NaN
+            table = np.array([level[0] for level in param], dtype=np.float32)
+            result_array = np.full(valid.shape, np.nan, dtype=np.float32)
+            result_array[valid] = table[param_array[counter]]
 
-                else:
+            # reshape to original dims, add metadata, convert to xr DataArray
+            result_array = result_array.reshape(S2vals.sizes[self.NAME_y], S2vals.sizes[self.NAME_x])
+            resultxr = xr.DataArray(data=result_array,dims=['y','x'], coords={'x':S2vals.x, 'y':S2vals.y})
 
-                    result_array = np.where(param_array[counter]==i, param[i][0], result_array)
+            results.append(resultxr)
 
-            # reshape to original dims, add metadata, convert to xr DataArray, apply mask
-            result_array = result_array.reshape(int(np.sqrt(len(stackedT))),int(np.sqrt(len(stackedT))))
-            resultxr = xr.DataArray(data=result_array,dims=['y','x'], coords={'x':S2vals.x, 'y':S2vals.y}).chunk(2000,2000)
-            
-            resultxr = resultxr.where(mask2 > 0)
-
-            # send to netcdf and flush memory
-            resultxr.to_netcdf(str(os.environ['PROCESS_DIR']+ "{}.nc".format(param_names[counter])))
-            
             result_array = None
             resultxr = None
-            counter +=1
 
-        
-        # retrieved params are saved as temporary netcdfs to the process_dir and then collated directly from 
-        # file into the final dataset in run_classifier.py
+        # retrieved params are returned in memory (densities, side_lengths, algae) and collated
+        # into the final dataset in run_classifier.py, avoiding a temporary netcdf round-trip via disk
 
-        return
+        return tuple(results)
 
     def run_ebmodel(self, alb):
 
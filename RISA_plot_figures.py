@@ -14,147 +14,199 @@ be transferred to a local machine for plotting if necessary.
 
 import xarray as xr
 import numpy as np
+import matplotlib as mpl
+# figures are only saved to file, so use the non-interactive backend and skip loading a GUI toolkit
+mpl.use('Agg')
 import matplotlib.pyplot as plt
 import glob
-import matplotlib as mpl
 import re
 import pandas as pd
+import dask
+import dask.array as daskar
+import functools
+from numba import njit, guvectorize
 plt.style.use('tableau-colorblind10')
 
+# factor converting retrieved algal concentration (ppb) to cells/mL, computed once as a reciprocal so
+# conversions are a single multiply
+cells_per_ppb = 1 / (np.pi*(4**2*40)*0.0014*0.3*(1/0.917)*10)
+
+# Pillow options for the jpg figures: an optimised Huffman table and quality 85 give much smaller files than
+# the defaults with no visible difference at 300 dpi. Passed as pil_kwargs, which matplotlib forwards to Pillow.
+jpg_options = dict(pil_kwargs={'quality': 85, 'optimize': True})
+
+# tiles covering the study area, in the order they are stacked along the "tile" dimension
+study_tiles = ('22wea', '22web', '22wec', '22wet', '22weu', '22wev')
+
 
 #############################################################
 #############################################################
 
 
-def JJA_maps(path, var, year, vmin, vmax, dpi=300):
+@njit
+def _block_stats(block):
 
     """
-    Function produces a 3-subplot figure where each subplot is the mean for
-    variable "var" over June, July or August in the year defined in variable "year".
+    Function returns the sum, sum of squares, count, min and max of the finite values
+    in one block, in a single pass and without allocating any temporaries. Accumulates
+    in float64 whatever the dtype of the block.
+
+    """
+
+    total = 0.0
+    total_sq = 0.0
+    count = 0
+    lo = np.inf
+    hi = -np.inf
+
+    for v in block.flat:
+        if np.isfinite(v):
+            total += v
+            total_sq += v*v
+            count += 1
+            lo = min(lo, v)
+            hi = max(hi, v)
+
+    return total, total_sq, count, lo, hi
+
+
+@guvectorize(['void(float32[:], float32[:])', 'void(float64[:], float64[:])'], '(t)->()', nopython=True,
+             target='parallel')
+def _nanmean(a, out):
+
+    """
+    Function averages the finite values along the last axis, summing and counting them in
+    the same loop. Pixels with no finite values are NaN.
+
+    """
+
+    total = 0.0
+    count = 0
+
+    for v in a:
+        if np.isfinite(v):
+            total += v
+            count += 1
+
+    out[0] = total/count if count > 0 else np.nan
+
+
+def open_tiles(path, var, year, tiles=study_tiles):
+
+    """
+    Function opens the reduced files for all tiles as one lazy dataset stacked along
+    a new "tile" dimension. The files are opened in parallel and read in chunks by dask
+    rather than one after another.
+
+    The tiles cover different areas, so their x/y coordinates are dropped before stacking
+    (all tiles share the same 5490 x 5490 pixel grid). Dates missing from a tile are NaN.
 
     params:
-    path: path to save file to
-    var: variable to plot (algae, grain_size, density, predict2BDA)
-    year: year to plot (2016,2017,2018,2019)
+    path: path to the reduced files
+    var: variable to open (algae, grain_size, density, predict2BDA)
+    year: year to open (2016,2017,2018,2019)
+    tiles: tiles to open, in the order they are stacked
 
     returns:
-    none, but figure saved to path
+    ds: dataset with dims (tile, date, y, x)
 
     """
 
-    wea = xr.open_dataset(str(path+'REDUCED_{}_22wea_{}.nc'.format(var,year)))
-    web = xr.open_dataset(str(path+'REDUCED_{}_22web_{}.nc'.format(var,year)))
-    wec = xr.open_dataset(str(path+'REDUCED_{}_22wec_{}.nc'.format(var,year)))
-    wet = xr.open_dataset(str(path+'REDUCED_{}_22wet_{}.nc'.format(var,year)))
-    weu = xr.open_dataset(str(path+'REDUCED_{}_22weu_{}.nc'.format(var,year)))
-    wev = xr.open_dataset(str(path+'REDUCED_{}_22wev_{}.nc'.format(var,year)))
-
-    JunStart = str(year+'0601')
-    JunEnd = str(year+'0630')
-    JulStart = str(year+'0701')
-    JulEnd = str(year+'0731')
-    AugStart = str(year+'0801')
-    AugEnd = str(year+'0831')
-    
-    wea_jun = wea[var].loc[JunStart:JunEnd].mean(dim='date')
-    web_jun = web[var].loc[JunStart:JunEnd].mean(dim='date')
-    wec_jun = wec[var].loc[JunStart:JunEnd].mean(dim='date')
-    wet_jun = wet[var].loc[JunStart:JunEnd].mean(dim='date')
-    weu_jun = weu[var].loc[JunStart:JunEnd].mean(dim='date')
-    wev_jun = wev[var].loc[JunStart:JunEnd].mean(dim='date')
-
-    wea_jul = wea[var].loc[JulStart:JulEnd].mean(dim='date')
-    web_jul = web[var].loc[JulStart:JulEnd].mean(dim='date')
-    wec_jul = wec[var].loc[JulStart:JulEnd].mean(dim='date')
-    wet_jul = wet[var].loc[JulStart:JulEnd].mean(dim='date')
-    weu_jul = weu[var].loc[JulStart:JulEnd].mean(dim='date')
-    wev_jul = wev[var].loc[JulStart:JulEnd].mean(dim='date')
-
-    wea_aug = wea[var].loc[AugStart:AugEnd].mean(dim='date')
-    web_aug = web[var].loc[AugStart:AugEnd].mean(dim='date')
-    wec_aug = wec[var].loc[AugStart:AugEnd].mean(dim='date')
-    wet_aug = wet[var].loc[AugStart:AugEnd].mean(dim='date')
-    weu_aug = weu[var].loc[AugStart:AugEnd].mean(dim='date')
-    wev_aug = wev[var].loc[AugStart:AugEnd].mean(dim='date')
+    files = [str(path+'REDUCED_{}_{}_{}.nc'.format(var,tile,year)) for tile in tiles]
 
-    plt.close()
-    fig,axes = plt.subplots(6,3)
-    plt.subplots_adjust(wspace=0.0001,hspace=0.001)
-    
-    axes[0,0].imshow(wec_jun,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[0,0].set_xticks([],[])
-    axes[0,0].set_yticks([],[])
+    # the index is wrapped in a list (one entry per nesting level), otherwise xarray reads it as one dimension per tile
+    ds = xr.open_mfdataset(files, concat_dim=[pd.Index(list(tiles), name='tile')], combine='nested', parallel=True,
+                           preprocess=lambda tile: tile.drop(['x', 'y']),
+                           chunks={'date': -1, 'y': 2048, 'x': 2048})
+
+    return ds
+
+
+@functools.lru_cache(maxsize=1)
+def annual_means(path, var, year):
+
+    """
+    Function returns the annual mean of "var" for every tile, persisted in memory by dask.
+    The most recent path/var/year is cached, so annual_stats, annual_maps and annual_histograms
+    called in turn for the same year share one pass over the files instead of each averaging the
+    dates again. Only one persisted stack is held in memory at a time.
+
+    params:
+    path: path to the reduced files
+    var: variable to average (algae, grain_size, density, predict2BDA)
+    year: year to average (2016,2017,2018,2019)
+
+    returns:
+    DataArray with dims (tile, y, x)
+
+    """
+
+    ds = open_tiles(path, var, year)
+
+    # the date axis is a single chunk, so the jitted mean runs on each (y, x) chunk in parallel
+    means = xr.apply_ufunc(_nanmean, ds[var], input_core_dims=[['date']], dask='parallelized',
+                           output_dtypes=[ds[var].dtype])
+
+    return means.persist()
 
-    axes[0,1].imshow(wec_jul,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[0,1].set_xticks([],[])
-    axes[0,1].set_yticks([],[])
 
-    axes[0,2].imshow(wec_aug,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[0,2].set_xticks([],[])
-    axes[0,2].set_yticks([],[])
+def monthly_means(da, months=(6, 7, 8)):
 
-    axes[1,0].imshow(web_jun,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[1,0].set_xticks([],[])
-    axes[1,0].set_yticks([],[])
+    """
+    Function calculates the mean of "da" over the dates in each of the given months
+    in a single grouped reduction over the date axis, rather than one slice and mean
+    per month.
+
+    params:
+    da: DataArray with a "date" dimension (yyyymmdd strings or datetimes)
+    months: months to keep (1-12)
+
+    returns:
+    DataArray with the "date" dimension replaced by "month"
 
-    axes[1,1].imshow(web_jul,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[1,1].set_xticks([],[])
-    axes[1,1].set_yticks([],[])
+    """
 
-    axes[1,2].imshow(web_aug,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[1,2].set_xticks([],[])
-    axes[1,2].set_yticks([],[])
+    month = pd.to_datetime(da.date.values).month
+    keep = np.isin(month, months)
 
+    month = xr.DataArray(month[keep], dims='date', name='month')
 
-    axes[2,0].imshow(wea_jun,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[2,0].set_xticks([],[])
-    axes[2,0].set_yticks([],[])
+    return da.isel(date=keep).groupby(month).mean(dim='date')
 
-    axes[2,1].imshow(wea_jul,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[2,1].set_xticks([],[])
-    axes[2,1].set_yticks([],[])
 
-    axes[2,2].imshow(wea_aug,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[2,2].set_xticks([],[])
-    axes[2,2].set_yticks([],[])
+def JJA_maps(path, var, year, vmin, vmax, dpi=300):
 
-    axes[3,0].imshow(wev_jun,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[3,0].set_xticks([],[])
-    axes[3,0].set_yticks([],[])
+    """
+    Function produces a 3-subplot figure where each subplot is the mean for
+    variable "var" over June, July or August in the year defined in variable "year".
 
-    axes[3,1].imshow(wev_jul, vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[3,1].set_xticks([],[])
-    axes[3,1].set_yticks([],[])
+    params:
+    path: path to save file to
+    var: variable to plot (algae, grain_size, density, predict2BDA)
+    year: year to plot (2016,2017,2018,2019)
 
-    axes[3,2].imshow(wev_aug,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[3,2].set_xticks([],[])
-    axes[3,2].set_yticks([],[])
+    returns:
+    none, but figure saved to path
 
-    axes[4,0].imshow(weu_jun,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[4,0].set_xticks([],[])
-    axes[4,0].set_yticks([],[])
+    """
 
-    axes[4,1].imshow(weu_jul,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[4,1].set_xticks([],[])
-    axes[4,1].set_yticks([],[])
+    ds = open_tiles(path, var, year)
 
-    axes[4,2].imshow(weu_aug,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[4,2].set_xticks([],[])
-    axes[4,2].set_yticks([],[])
+    # June, July and August means for all six tiles from one pass over the date axis, computed together into
+    # one (tile, month, y, x) array with the tiles in the order of the figure rows (north to south)
+    rows = ['22wec', '22web', '22wea', '22wev', '22weu', '22wet']
+    monthly = monthly_means(ds[var]).sel(tile=rows).transpose('tile', 'month', 'y', 'x').values
 
-    axes[5,0].imshow(wet_jun,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[5,0].set_xticks([],[])
-    axes[5,0].set_yticks([],[])
+    plt.close()
+    fig,axes = plt.subplots(6,3,subplot_kw=dict(xticks=[],yticks=[]))
+    plt.subplots_adjust(wspace=0.0001,hspace=0.001)
 
-    axes[5,1].imshow(wet_jul,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[5,1].set_xticks([],[])
-    axes[5,1].set_yticks([],[])
+    for i in range(len(rows)):
+        for j in range(3):
 
-    axes[5,2].imshow(wet_aug,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[5,2].set_xticks([],[])
-    axes[5,2].set_yticks([],[])
+            axes[i,j].imshow(monthly[i,j],vmin=vmin,vmax=vmax, cmap=cmap, rasterized=True)
 
-    plt.savefig(str(path+'/JJA_{}_{}.jpg'.format(var,year)), dpi = dpi)
+    plt.savefig(str(path+'/JJA_{}_{}.jpg'.format(var,year)), dpi = dpi, **jpg_options)
     
     return
 
@@ -175,67 +227,27 @@ def JJA_stats(path, var, year):
 
     """
 
-    wea = xr.open_dataset(str(path+'REDUCED_{}_22wea_{}.nc'.format(var,year)))
-    web = xr.open_dataset(str(path+'REDUCED_{}_22web_{}.nc'.format(var,year)))
-    wec = xr.open_dataset(str(path+'REDUCED_{}_22wec_{}.nc'.format(var,year)))
-    wet = xr.open_dataset(str(path+'REDUCED_{}_22wet_{}.nc'.format(var,year)))
-    weu = xr.open_dataset(str(path+'REDUCED_{}_22weu_{}.nc'.format(var,year)))
-    wev = xr.open_dataset(str(path+'REDUCED_{}_22wev_{}.nc'.format(var,year)))
-
-    JunStart = str(year+'0601')
-    JunEnd = str(year+'0630')
-    JulStart = str(year+'0701')
-    JulEnd = str(year+'0731')
-    AugStart = str(year+'0801')
-    AugEnd = str(year+'0831')
-
+    ds = open_tiles(path, var, year)
 
-    for month in ['Jun','Jul','Aug']:
+    # monthly means of the summarised tiles, computed once in a single pass over the date axis
+    monthly = monthly_means(ds[var].sel(tile=['22wev'])).compute()
 
-        values = []
-        count = []
+    for month in [6, 7, 8]:
 
-        if month == 'Jun':
-            Start = JunStart
-            End = JunEnd
-        elif month == 'Jul':
-            Start = JulStart
-            End = JulEnd
-        elif month == 'Aug':
-            Start = AugStart
-            End = AugEnd
+        tile = monthly.sel(month=month).astype(np.float64)
 
         # CALC MEAN
 
-        for tile in [wev]:
-            
-            tile = tile[var].loc[Start:End].mean(dim='date')
-            tile_sum = tile.sum()
-            tile_count = tile.count()
-            values.append(tile_sum.values)
-            count.append(tile_count.values)
-
-        val = np.array(values).sum()
-        co = np.array(count).sum()
+        val = tile.sum().values
+        co = tile.count().values
 
         dz_mean = val/co
         print(dz_mean)
 
 
-        # CALC STDEV
+        # CALC STDEV from the sum of squares, in the same pass as the mean
 
-        SD_list = []
-
-        for tile in [wev]:
-            
-            tile = tile[var].loc[Start:End].mean(dim='date')
-            tile = (tile - dz_mean)**2
-
-            SD_list.append(tile.sum())
-
-       
-        tile_sum = (np.array(SD_list).sum()) / co
-        SD = np.sqrt(tile_sum)
+        SD = np.sqrt(max((tile**2).sum().values/co - dz_mean**2, 0))
 
         print("STDEV = ", SD)
             
@@ -257,50 +269,23 @@ def annual_stats(path, var, year):
 
     """
     
-    wea = xr.open_dataset(str(path+'REDUCED_{}_22wea_{}.nc'.format(var,year)))
-    web = xr.open_dataset(str(path+'REDUCED_{}_22web_{}.nc'.format(var,year)))
-    wec = xr.open_dataset(str(path+'REDUCED_{}_22wec_{}.nc'.format(var,year)))
-    wet = xr.open_dataset(str(path+'REDUCED_{}_22wet_{}.nc'.format(var,year)))
-    weu = xr.open_dataset(str(path+'REDUCED_{}_22weu_{}.nc'.format(var,year)))
-    wev = xr.open_dataset(str(path+'REDUCED_{}_22wev_{}.nc'.format(var,year)))
-
-    values = []
-    count = []
-    maxlist = []
-    minlist = []
-
-    for tile in [wea, web, wec, wet, weu, wev]:
-        
-        tile = tile[var].mean(dim='date')
-        tile_sum = tile.sum()
-        tile_count = tile.count()
-        values.append(tile_sum.values)
-        count.append(tile_count.values)
-        maxlist.append(tile.max().values)
-        minlist.append(tile.min().values)
-
-    val = np.array(values).sum()
-    co = np.array(count).sum()
-
-    dz_mean = val/co
-    print("mean = ",dz_mean)
-    print("min = ", np.array(minlist).min())
-    print("max = ", np.array(maxlist).max())
-
-    # CALC STDEV
-
-    SD_list = []
+    # annual mean of each pixel in every tile
+    tile = annual_means(path, var, year)
 
-    for tile in [wea, web, wec, wet, weu, wev]:
-        
-        tile = tile[var].mean(dim='date')
-        tile = (tile - dz_mean)**2
+    # sum, sum of squares, count, min and max are accumulated per dask block by the jitted kernel and
+    # combined here, so the data is streamed from disk once and no squared copy of the tile is made
+    blocks = dask.compute(*[dask.delayed(_block_stats)(block) for block in tile.data.to_delayed().ravel()])
+    total, total_sq, co, lo, hi = zip(*blocks)
 
-        SD_list.append(tile.sum())
+    co = sum(co)
+    dz_mean = sum(total)/co
+    print("mean = ",dz_mean)
+    print("min = ", min(lo))
+    print("max = ", max(hi))
 
+    # CALC STDEV
 
-    tile_sum = (np.array(SD_list).sum()) / co
-    SD = np.sqrt(tile_sum)
+    SD = np.sqrt(max(sum(total_sq)/co - dz_mean**2, 0))
 
     print("STDEV = ", SD)
             
@@ -324,48 +309,18 @@ def annual_maps(path, var, year, vmin, vmax, dpi=300):
     none, figure saved to path
 
     """
-    wea = xr.open_dataset(str(path+'REDUCED_{}_22wea_{}.nc'.format(var,year)))
-    web = xr.open_dataset(str(path+'REDUCED_{}_22web_{}.nc'.format(var,year)))
-    wec = xr.open_dataset(str(path+'REDUCED_{}_22wec_{}.nc'.format(var,year)))
-    wet = xr.open_dataset(str(path+'REDUCED_{}_22wet_{}.nc'.format(var,year)))
-    weu = xr.open_dataset(str(path+'REDUCED_{}_22weu_{}.nc'.format(var,year)))
-    wev = xr.open_dataset(str(path+'REDUCED_{}_22wev_{}.nc'.format(var,year)))
-
-    wea_mean = wea[var].mean(dim='date')
-    web_mean = web[var].mean(dim='date')
-    wec_mean = wec[var].mean(dim='date')
-    wet_mean = wet[var].mean(dim='date')
-    weu_mean = weu[var].mean(dim='date')
-    wev_mean = wev[var].mean(dim='date')
-
-    fig,axes = plt.subplots(6,1)
-    plt.subplots_adjust(wspace=0.000001,hspace=0.001)
-    
-    axes[0].imshow(wec_mean,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[0].set_xticks([],[])
-    axes[0].set_yticks([],[])
-
-    axes[1].imshow(web_mean,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[1].set_xticks([],[])
-    axes[1].set_yticks([],[])
-
-    axes[2].imshow(wea_mean,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[2].set_xticks([],[])
-    axes[2].set_yticks([],[])
+    means = annual_means(path, var, year)
 
-    axes[3].imshow(wev_mean,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[3].set_xticks([],[])
-    axes[3].set_yticks([],[])
+    # figure rows run north to south
+    rows = ['22wec', '22web', '22wea', '22wev', '22weu', '22wet']
 
-    axes[4].imshow(weu_mean,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[4].set_xticks([],[])
-    axes[4].set_yticks([],[])
+    fig,axes = plt.subplots(6,1,subplot_kw=dict(xticks=[],yticks=[]))
+    plt.subplots_adjust(wspace=0.000001,hspace=0.001)
 
-    axes[5].imshow(wet_mean,vmin=vmin,vmax=vmax, cmap=cmap)
-    axes[5].set_xticks([],[])
-    axes[5].set_yticks([],[])
+    for ax, tile in zip(axes, rows):
+        ax.imshow(means.sel(tile=tile),vmin=vmin,vmax=vmax, cmap=cmap, rasterized=True)
 
-    plt.savefig(str(path+'annual_mean_{}.jpg'.format(year)),dpi=dpi)
+    plt.savefig(str(path+'annual_mean_{}.jpg'.format(year)),dpi=dpi, **jpg_options)
 
     return
 
@@ -384,29 +339,19 @@ def annual_histograms(path, var, year):
     none, figure saved to path
 
     """
-    wea = xr.open_dataset(str(path+'REDUCED_{}_22wea_{}.nc'.format(var,year)))
-    web = xr.open_dataset(str(path+'REDUCED_{}_22web_{}.nc'.format(var,year)))
-    wec = xr.open_dataset(str(path+'REDUCED_{}_22wec_{}.nc'.format(var,year)))
-    wet = xr.open_dataset(str(path+'REDUCED_{}_22wet_{}.nc'.format(var,year)))
-    weu = xr.open_dataset(str(path+'REDUCED_{}_22weu_{}.nc'.format(var,year)))
-    wev = xr.open_dataset(str(path+'REDUCED_{}_22wev_{}.nc'.format(var,year)))
-
-    wea_mean = wea[var].mean(dim='date')
-    web_mean = web[var].mean(dim='date')
-    wec_mean = wec[var].mean(dim='date')
-    wet_mean = wet[var].mean(dim='date')
-    weu_mean = weu[var].mean(dim='date')
-    wev_mean = wev[var].mean(dim='date')
-
-    tot = xr.merge([wea_mean,web_mean,wec_mean,wet_mean,weu_mean,wev_mean])
-    tot = tot/ (np.pi*(4**2*40)*0.0014*0.3*(1/0.917)*10)
-
-    plt.hist(np.ravel(tot.to_array()),bins=100)
+    means = annual_means(path, var, year)
+
+    # bin the annual means of all tiles against fixed edges chunk by chunk with dask; NaNs fall
+    # outside the edges and are not counted
+    counts, edges = daskar.histogram(means.data * cells_per_ppb, bins=100, range=(0, 30000))
+    counts = counts.compute()
+
+    plt.hist(edges[:-1], bins=edges, weights=counts)
     plt.xlim(0, 30000)
     plt.ylim(0, 2.5E7)
     plt.ylabel('Frequency')
     plt.xlabel('Algae concentration (cells/mL)')
-    plt.savefig(str(path+'histogram_{}.jpg'.format(year)),dpi=dpi)
+    plt.savefig(str(path+'histogram_{}.jpg'.format(year)),dpi=dpi, **jpg_options)
 
     return
 
@@ -429,14 +374,18 @@ def plot_BandRatios(savepath,dpi):
 
     """
 
-    BandRatios = pd.read_csv('/home/joe/Code/Remote_Ice_Surface_Analyser/RISA_OUT/BandRatios.csv')
+    BandRatios = pd.read_csv('/home/joe/Code/Remote_Ice_Surface_Analyser/RISA_OUT/BandRatios.csv',
+                             dtype={'Index': 'category'})
+
+    # split the table by index name in one pass rather than one string comparison per index
+    groups = dict(list(BandRatios.groupby('Index', observed=True)))
 
-    DBA2 = BandRatios[BandRatios['Index']=='2DBA']
-    DBA3 = BandRatios[BandRatios['Index']=='3DBA']
-    NDCI = BandRatios[BandRatios['Index']=='NCDI']
-    MCI = BandRatios[BandRatios['Index']=='MCI']
-    II = BandRatios[BandRatios['Index']=='II']
-    DBA2_2 = BandRatios[BandRatios['Index']=='2DBA2']
+    DBA2 = groups['2DBA']
+    DBA3 = groups['3DBA']
+    NDCI = groups['NCDI']
+    MCI = groups['MCI']
+    II = groups['II']
+    DBA2_2 = groups['2DBA2']
 
     fig, ax = plt.subplots(3,2,figsize=(10,8))
     
@@ -504,128 +453,105 @@ def add_boxes_to_rgb():
     rect5 = patches.Rectangle((4700,4500),200,200, edgecolor='k', facecolor="none")
     ax.add_patch(rect1),ax.add_patch(rect2),ax.add_patch(rect3),ax.add_patch(rect4),ax.add_patch(rect5)
 
-    ax.imshow(im)
+    ax.imshow(im, rasterized=True)
 
-    plt.savefig('/home/joe/Code/BigIceSurfClassifier/RISA_OUT/rgb_boxes.jpg',dpi=300)
+    plt.savefig('/home/joe/Code/BigIceSurfClassifier/RISA_OUT/rgb_boxes.jpg',dpi=300, **jpg_options)
 
     return
 
 
-def time_series(path, var):
+def read_summer_csv(csv, year, start='06-01', end='08-18'):
 
-    for year in ['2016','2017','2018','2019']:
-
-        ds = xr.open_dataset('/datadrive2/BigIceSurfClassifier/Process_Dir/outputs/REDUCED_{}_22wev_{}.nc'.format(var,year))
-        ds2 = xr.open_dataset('/datadrive2/BigIceSurfClassifier/Process_Dir/outputs/REDUCED_{}_22wev_{}.nc'.format('classified',year))
-        
-        area1 = ds[dict(y=slice(4200, 4400),x=slice(1500,1700))]
-        area2 = ds[dict(y=slice(4000, 4200),x=slice(2000,2200))]
-        area3 = ds[dict(y=slice(4000, 4200),x=slice(2300,2500))]
-        area4 = ds[dict(y=slice(4300, 4500),x=slice(3500,3700))]
-        area5 = ds[dict(y=slice(4300, 4500),x=slice(4500,4700))]
-        area6 = ds[dict(y=slice(4700, 4900),x=slice(4500,4700))]
-        
-
-        area1class = ds2[dict(y=slice(4200, 4400),x=slice(1500,1700))]
-        area2class = ds2[dict(y=slice(4000, 4200),x=slice(2000,2200))]
-        area3class = ds2[dict(y=slice(4000, 4200),x=slice(2300,2500))]
-        area4class = ds2[dict(y=slice(4300, 4500),x=slice(3500,3700))]
-        area5class = ds2[dict(y=slice(4300, 4500),x=slice(4500,4700))]
-        area6class = ds2[dict(y=slice(4700, 4900),x=slice(4500,4700))]
-        
-        area1means = []
-        area1SN = []
-        area2means = []
-        area2SN = []
-        area3means = []
-        area3SN = []
-        area4means = []
-        area4SN = []
-        area5means = []
-        area5SN = []
-        area6means = []
-        area6SN = []
-
-        for i in ds.date:
-
-            area1means.append(area1[var].loc[i.values].mean().values)
-            area2means.append(area2[var].loc[i.values].mean().values)
-            area3means.append(area3[var].loc[i.values].mean().values)
-            area4means.append(area4[var].loc[i.values].mean().values)
-            area5means.append(area5[var].loc[i.values].mean().values)            
-            area6means.append(area6[var].loc[i.values].mean().values)
-            
-        
-        for ii in ds2.date:
-            area1SN.append(area1class.classified.loc[ii.values].where(area1class.classified.loc[ii.values].values==1).count().values)
-            area2SN.append(area1class.classified.loc[ii.values].where(area2class.classified.loc[ii.values].values==1).count().values)
-            area3SN.append(area1class.classified.loc[ii.values].where(area3class.classified.loc[ii.values].values==1).count().values)
-            area4SN.append(area1class.classified.loc[ii.values].where(area4class.classified.loc[ii.values].values==1).count().values)
-            area5SN.append(area5class.classified.loc[ii.values].where(area5class.classified.loc[ii.values].values==1).count().values)
-            area6SN.append(area6class.classified.loc[ii.values].where(area6class.classified.loc[ii.values].values==1).count().values)
-
-                
-        df = pd.DataFrame(columns=['date','area1','area2','area3','area4','area5','area6'])
-        df.date = ds.date.values      
-        df.date = pd.to_datetime(df.date)
-
-        df2 = pd.DataFrame(columns=['date','area1SN','area2SN','area3SN','area4SN','area5SN','area6SN'])
-        df2.date = ds2.date.values      
-        df2.date = pd.to_datetime(df2.date)
-
-        df.area1 = np.array(area1means)/ (np.pi*(4**2*40)*0.0014*0.3*(1/0.917)*10)
-        df2.area1SN = (np.array(area1SN) * 0.0004 / (200*200*0.0004))*100
-        df.area2 = np.array(area2means)/ (np.pi*(4**2*40)*0.0014*0.3*(1/0.917)*10)
-        df2.area2SN = (np.array(area2SN) * 0.0004 / (200*200*0.0004))*100
-        df.area3 = np.array(area3means)/ (np.pi*(4**2*40)*0.0014*0.3*(1/0.917)*10)
-        df2.area3SN = (np.array(area3SN) * 0.0004 / (200*200*0.0004))*100
-        df.area4 = np.array(area4means)/ (np.pi*(4**2*40)*0.0014*0.3*(1/0.917)*10)
-        df2.area4SN = (np.array(area4SN) * 0.0004 / (200*200*0.0004))*100
-        df.area5 = np.array(area5means)/ (np.pi*(4**2*40)*0.0014*0.3*(1/0.917)*10)
-        df2.area5SN = (np.array(area5SN) * 0.0004 / (200*200*0.0004))*100
-        df.area6 = np.array(area5means)/ (np.pi*(4**2*40)*0.0014*0.3*(1/0.917)*10)
-        df2.area6SN = (np.array(area6SN) * 0.0004 / (200*200*0.0004))*100
+    """
+    Function reads one of the time series csv files written by time_series, parsing the
+    date column on read, and keeps the rows between the start and end dates (inclusive)
 
-        r = pd.date_range(start=df.date.min(), end=df.date.max())
-        df.set_index('date').reindex(r).rename_axis('date').reset_index(inplace=True)
-        df.to_csv(str(path+'/DF_{}.csv'.format(year)),index=None)
+    params:
+    csv: path to csv file
+    year: year of the file (2016,2017,2018,2019)
+    start, end: first and last day to keep as mm-dd
 
-        r2 = pd.date_range(start=df2.date.min(), end=df2.date.max())
-        df2.set_index('date').reindex(r2).rename_axis('date').reset_index(inplace=True)
-        df2.to_csv(str(path+'/DF_{}_CLASS.csv'.format(year)),index=None)
+    returns:
+    DataFrame
+
+    """
+
+    df = pd.read_csv(csv, parse_dates=['date'])
+
+    return df[df.date.between('{}-{}'.format(year, start), '{}-{}'.format(year, end))]
+
+
+def study_area_series(var, year):
+
+    """
+    Function builds (lazily, with dask) the time series for the six study areas in tile 22wev:
+    the mean of "var" and the number of snow (class 1) pixels in each area on every date
+
+    params:
+    var: variable to average (algae, grain_size, density, predict2BDA)
+    year: year to use (2016,2017,2018,2019)
+
+    returns:
+    means, SN: dask-backed DataArrays with dims (area, date)
+
+    """
+
+    # only 200 x 200 pixel areas are used, so open in small chunks (multiples of the 512 x 512 chunks the files
+    # are written with) so that each area only reads the few chunks it overlaps rather than the whole tile
+    ds = xr.open_dataset('/datadrive2/BigIceSurfClassifier/Process_Dir/outputs/REDUCED_{}_22wev_{}.nc'.format(var,year),
+                         chunks={'date': -1, 'y': 512, 'x': 512})
+    ds2 = xr.open_dataset('/datadrive2/BigIceSurfClassifier/Process_Dir/outputs/REDUCED_{}_22wev_{}.nc'.format('classified',year),
+                          chunks={'date': -1, 'y': 512, 'x': 512})
+
+    # study areas as (y, x) pixel ranges
+    areas = [((4200, 4400), (1500, 1700)), ((4000, 4200), (2000, 2200)), ((4000, 4200), (2300, 2500)),
+             ((4300, 4500), (3500, 3700)), ((4300, 4500), (4500, 4700)), ((4700, 4900), (4500, 4700))]
+
+    # each built as one (area, date) array rather than one small reduction per area per date
+    means = xr.concat([ds[var].isel(y=slice(*ys), x=slice(*xs)).mean(dim=('y', 'x'))
+                       for ys, xs in areas], dim='area')
+    SN = xr.concat([(ds2.classified.isel(y=slice(*ys), x=slice(*xs)) == 1).sum(dim=('y', 'x'))
+                    for ys, xs in areas], dim='area')
+
+    return means, SN
+
+
+def time_series(path, var):
 
+    years = ['2016','2017','2018','2019']
 
-    DF2016 = pd.read_csv(str(path+'/DF_2016.csv'))
-    DF2016.date = pd.to_datetime(DF2016.date)
-    DF2016 = DF2016[DF2016["date"].isin(pd.date_range("2016-06-01", "2016-08-18"))]
+    # every year reads its own files, so the series for all four years are computed together in one
+    # scheduler run, which works through the years in parallel rather than one after another
+    series = dask.compute(*[study_area_series(var, year) for year in years])
 
-    DF2016Class = pd.read_csv(str(path+'/DF_2016_CLASS.csv'))
-    DF2016Class.date = pd.to_datetime(DF2016Class.date)
-    DF2016Class = DF2016Class[DF2016Class["date"].isin(pd.date_range("2016-06-01", "2016-08-18"))]
+    for year, (means, SN) in zip(years, series):
 
-    DF2017 = pd.read_csv(str(path+'DF_2017.csv'))
-    DF2017.date = pd.to_datetime(DF2017.date)
-    DF2017 = DF2017[DF2017["date"].isin(pd.date_range("2017-06-01", "2017-08-18"))]
+        # one column per area, built in one go from the (area, date) arrays
+        df = pd.DataFrame(means.values.T * cells_per_ppb,
+                          columns=['area{}'.format(n+1) for n in range(len(means))])
+        df.insert(0, 'date', pd.to_datetime(means.date.values))
 
-    DF2017Class = pd.read_csv(str(path+'/DF_2017_CLASS.csv'))
-    DF2017Class.date = pd.to_datetime(DF2017Class.date)
-    DF2017Class = DF2017Class[DF2017Class["date"].isin(pd.date_range("2017-06-01", "2017-08-18"))]
+        df2 = pd.DataFrame((SN.values.T * 0.0004 / (200*200*0.0004))*100,
+                           columns=['area{}SN'.format(n+1) for n in range(len(SN))])
+        df2.insert(0, 'date', pd.to_datetime(SN.date.values))
 
-    DF2018 = pd.read_csv(str(path+'/DF_2018.csv'))
-    DF2018.date = pd.to_datetime(DF2018.date)
-    DF2018 = DF2018[DF2018["date"].isin(pd.date_range("2018-06-01", "2018-08-18"))]
+        r = pd.date_range(start=df.date.min(), end=df.date.max())
+        df.set_index('date').reindex(r).rename_axis('date').reset_index(inplace=True)
+        df.to_csv(str(path+'/DF_{}.csv'.format(year)),index=None)
 
-    DF2018Class = pd.read_csv(str(path+'/DF_2018_CLASS.csv'))
-    DF2018Class.date = pd.to_datetime(DF2018Class.date)
-    DF2018Class = DF2018Class[DF2018Class["date"].isin(pd.date_range("2018-06-01", "2018-08-18"))]
+        r2 = pd.date_range(start=df2.date.min(), end=df2.date.max())
+        df2.set_index('date').reindex(r2).rename_axis('date').reset_index(inplace=True)
+        df2.to_csv(str(path+'/DF_{}_CLASS.csv'.format(year)),index=None)
 
-    DF2019 = pd.read_csv(str(path+'/DF_2019.csv'))
-    DF2019.date = pd.to_datetime(DF2019.date)
-    DF2019 = DF2019[DF2019["date"].isin(pd.date_range("2019-06-01", "2019-08-18"))]
 
-    DF2019Class = pd.read_csv(str(path+'/DF_2019_CLASS.csv'))
-    DF2019Class.date = pd.to_datetime(DF2019Class.date)
-    DF2019Class = DF2019Class[DF2019Class["date"].isin(pd.date_range("2019-06-01", "2019-08-18"))]
+    DF2016 = read_summer_csv(str(path+'/DF_2016.csv'), '2016')
+    DF2016Class = read_summer_csv(str(path+'/DF_2016_CLASS.csv'), '2016')
+    DF2017 = read_summer_csv(str(path+'/DF_2017.csv'), '2017')
+    DF2017Class = read_summer_csv(str(path+'/DF_2017_CLASS.csv'), '2017')
+    DF2018 = read_summer_csv(str(path+'/DF_2018.csv'), '2018')
+    DF2018Class = read_summer_csv(str(path+'/DF_2018_CLASS.csv'), '2018')
+    DF2019 = read_summer_csv(str(path+'/DF_2019.csv'), '2019')
+    DF2019Class = read_summer_csv(str(path+'/DF_2019_CLASS.csv'), '2019')
     
     
     plt.close()
@@ -713,7 +639,7 @@ def time_series(path, var):
 
     fig.tight_layout()
 
-    plt.savefig(str(path+'/time_series.jpg'),dpi=300)
+    plt.savefig(str(path+'/time_series.jpg'),dpi=300, **jpg_options)
 
     return
 
@@ -725,21 +651,18 @@ def colorbar(vmin, vmax, cmap):
 
     """
 
-    vmin = vmin / (np.pi*(4**2*40)*0.0014*0.3*(1/0.917)*10)
-    vmax = vmax / (np.pi*(4**2*40)*0.0014*0.3*(1/0.917)*10)
+    vmin = vmin * cells_per_ppb
+    vmax = vmax * cells_per_ppb
 
-    fig, ax = plt.subplots(1, 1)
-
-    fraction = 1
+    # draw the bar straight onto one narrow axes rather than stealing space from a hidden
+    # full-size plot, so only the colorbar itself is laid out and rendered
+    fig = plt.figure(figsize=(1.5, 4.8))
+    cax = fig.add_axes([0.1, 0.05, 0.3, 0.9])
 
     norm = mpl.colors.Normalize(vmin=vmin, vmax=vmax)
-    cbar = ax.figure.colorbar(
-                mpl.cm.ScalarMappable(norm=norm, cmap=cmap),
-                ax=ax, pad=.05, extend='both', fraction=fraction)
+    cbar = mpl.colorbar.ColorbarBase(cax, cmap=cmap, norm=norm, extend='both')
 
-    ax.axis('off')
-    
-    plt.savefig(str(path+'colorbar.jpg'),dpi=300)
+    plt.savefig(str(path+'colorbar.jpg'),dpi=300, **jpg_options)
     
     return
 
@@ -780,7 +703,7 @@ def bar_plots(path,dpi):
     
 
     plt.tight_layout()
-    plt.savefig(str(path+'bar_plots.jpg'),dpi=dpi)
+    plt.savefig(str(path+'bar_plots.jpg'),dpi=dpi, **jpg_options)
 
     return
 
@@ -819,12 +742,11 @@ def albedo_reducing_power():
     fig = plt.figure()
     ax1 = fig.add_subplot(111)
 
-    ax1.plot(dAlbDS['reff'],dAlbDS['20000'],marker = 'x',label='20000 ppb')
-    ax1.plot(dAlbDS['reff'],dAlbDS['30000'],marker = 'x',label='30000 ppb')
-    ax1.plot(dAlbDS['reff'],dAlbDS['40000'],marker = 'x',label='40000 ppb')
-    ax1.plot(dAlbDS['reff'],dAlbDS['50000'],marker = 'x',label='50000 ppb')
-    ax1.plot(dAlbDS['reff'],dAlbDS['60000'],marker = 'x',label='60000 ppb')
-    ax1.plot(dAlbDS['reff'],dAlbDS['80000'],marker = 'x',label='80000 ppb')
+    # all six concentrations drawn from one (reff, conc) array in a single plot call
+    concs = ['20000', '30000', '40000', '50000', '60000', '80000']
+    lines = ax1.plot(dAlbDS['reff'].values, dAlbDS[concs].values, marker = 'x')
+    for line, conc in zip(lines, concs):
+        line.set_label('{} ppb'.format(conc))
     ax1.set_ylim(0.01,0.07)
     
     # ax1.set_xticklabels(dAlbDS['reff'])
@@ -835,7 +757,7 @@ def albedo_reducing_power():
     plt.legend(bbox_to_anchor=(0.95,0.99),ncol=3)
     plt.tight_layout()
 
-    plt.savefig(str(path+'RTM_Experiment.jpg'),dpi=300)
+    plt.savefig(str(path+'RTM_Experiment.jpg'),dpi=300, **jpg_options)
 
 
 
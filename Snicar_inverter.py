@@ -14,9 +14,6 @@ for testing, reduce the image size to 250000 pixels or less - this runs ok on JC
 i.e. stackedT = stackedT[0:250000]
 
 
-
-TODO: APPLY THE RETRIEVAL TO THE IMAGE *AFTER* THE MASK IS APPLIED TO LIMIT NO OF COMPUTATIONS AND REDUCE RUNTIME
-
 """
 
 import numpy as np
@@ -31,119 +28,143 @@ import os
 #####################################
 
 
-def invert_snicar(S2xr):
+def invert_snicar(S2xr, mask2, side_lengths, densities, dust, algae, wavelengths, idx):
 
 
-        """
-        Pixelwise retrieval of snicar RT params by matching spectra against snicar-generated LUT loaded from process_dir
-        """
-        
-        # stack the values into a 1D array
-        stacked = S2vals.Data.stack(allpoints=[self.NAME_y,self.NAME_x])
+    """
+    Pixelwise retrieval of snicar RT params by matching spectra against snicar-generated LUT loaded from process_dir
+
+    side_lengths, densities, dust and algae are the parameter grids the LUT was generated over, in LUT axis order,
+    wavelengths are the LUT's wavelengths and idx the positions of the S2 bands in them. mask2 is the combined
+    ice/cloud mask (y, x); retrievals outside it are set to NaN.
+    """
+    
+    S2vals = S2xr
 
-        # Transpose and rename so that DataArray has exactly the same layout/labels as the training DataArray.
-        stackedT = stacked.T
-        stackedT = stackedT.rename({'allpoints': 'samples'})
+    # flatten to (samples, bands) on the underlying dask array. stack() would build a MultiIndex over every
+    # pixel, which loads the data.
+    # Only pixels inside the combined ice/cloud mask are matched against the LUT, since everything
+    # else is masked out of the result anyway.
+    valid = np.asarray(mask2).ravel() > 0
 
-        # RECHUNK STACKEDT: choice of chunk size is crucial for maximising speed while preventing memory over-allocation.
-        # While 20000 seems small there are very large intermediate arrays spawned by the compute() function.
-        # chunks >~20000 give memory error due to size of intermediate arrays 
-        stackedT = stackedT.chunk(20000,9)
+    stackedT = S2vals.Data.transpose('y', 'x', 'bands').data
+    stackedT = stackedT.reshape(-1, S2vals.sizes['bands'])[valid]
 
-        # reformat LUT: flatten LUT from 3D to 2D array with one column per combination of RT params, one row per wavelength
-        LUT = np.load(str(os.environ['PROCESS_DIR'] + 'SNICAR_LUT_2058.npy')).reshape(2058,len(wavelengths))
+    # RECHUNK STACKEDT: choice of chunk size is crucial for maximising speed while preventing memory over-allocation.
+    # While 10000 seems small there are very large intermediate arrays spawned by the compute() function.
+    # chunks >~20000 gave memory errors with the float16 error array; the error array is now float32 (twice
+    # the bytes per element) so the chunk is halved to keep the same peak memory.
+    # Going from 2000x2000 (y, x) blocks to 1D sample blocks is a many-to-many rechunk, so it is done by
+    # dask.array.rechunk, which plans it through intermediate chunk sizes rather than splitting every input
+    # block into every output block.
+    stackedT = xr.DataArray(stackedT.rechunk((10000, -1)), dims=('samples', 'bands'))
 
-        # find most similar LUT spectrum for each pixel in S2 image
-        # astype(float 16) to reduce memory allocation (default was float64)
-        LUT = LUT[:,idx] # reduce wavelengths to only the 9 that match the S2 image
+    # reformat LUT: flatten LUT from 3D to 2D array with one column per combination of RT params, one row per wavelength
+    LUT = np.load(str(os.environ['PROCESS_DIR'] + 'SNICAR_LUT_2058.npy')).reshape(-1,len(wavelengths))
 
-        LUT = xr.DataArray(LUT,dims=('spectrum','bands')).astype(np.float16)
+    n_spectra = len(side_lengths) * len(densities) * len(dust) * len(algae)
 
-        error_array = LUT - stackedT.astype(np.float16)  # subtract reflectance from snicar reflectance pixelwise
-        idx_array = xr.apply_ufunc(abs,error_array,dask='allowed')
-        idx_array = xr.apply_ufunc(np.mean,idx_array,input_core_dims=[['bands']],dask='allowed',kwargs={'axis':-1})
-        idx_array = xr.apply_ufunc(np.argmin,idx_array,input_core_dims=[['spectrum']],dask='allowed',kwargs={'axis':-1})
+    if LUT.shape[0] != n_spectra:
+        raise ValueError("LUT has {} spectra but the parameter grids describe {}. The grids must be the ones the LUT "
+                         "was generated over.".format(LUT.shape[0], n_spectra))
 
+    # find most similar LUT spectrum for each pixel in S2 image
+    # astype(float 32) to reduce memory allocation (default was float64). float16 would halve it again, but
+    # x86 has no float16 arithmetic so every element would be converted to float32 and back at each step.
+    LUT = LUT[:,idx] # reduce wavelengths to only the 9 that match the S2 image
 
-        # unravel index computes the index in the original n-dimeniona LUT from the index in the flattened LUT
-        @dask.delayed
-        def unravel(idx_array,side_lengths,densities,dust,algae):
-            param_array = np.array(np.unravel_index(idx_array,[len(side_lengths),len(densities),len(dust),len(algae)]))
-            return param_array
+    LUT = xr.DataArray(LUT,dims=('spectrum','bands')).astype(np.float32)
 
-        param_array = unravel(idx_array,side_lengths,densities,dust,algae)
-        param_array = np.array(param_array.compute())
+    error_array = LUT - stackedT.astype(np.float32)  # subtract reflectance from snicar reflectance pixelwise
+    # abs, sum and argmin dispatch straight to dask.array, so they fuse into the subtraction's
+    # tasks rather than adding an apply_ufunc layer per step. The sum ranks spectra the same as the mean.
+    idx_array = abs(error_array).sum(dim='bands').argmin(dim='spectrum')
 
-        print("param_array shape = ",param_array.shape)
-        print("param_array type = ",type(param_array))
-        
-        # flush disk
-        idx_array = None
-        error_array = None
-        dirtyLUT = None
 
-        #use the indexes to retrieve the actual parameter values for each pixel from the LUT indexes
-        # since the values are assumed equal in all vertical layers (side_lengths and density) or only the top layer (LAPs)
-        # only the first value from the parameter arrays is needed.
+    # unravel index computes the index in the original n-dimeniona LUT from the index in the flattened LUT
+    @dask.delayed
+    def unravel(idx_array,side_lengths,densities,dust,algae):
+        param_array = np.array(np.unravel_index(idx_array,[len(side_lengths),len(densities),len(dust),len(algae)]))
+        return param_array
 
-        counter = 0
-        param_names = ['side_lengths','densities','dust','algae']
-        for param in [side_lengths, densities, dust, algae]:
+    param_array = unravel(idx_array,side_lengths,densities,dust,algae)
+    param_array = np.array(param_array.compute())
 
-            for i in np.arange(0,len(param),1):
+    # flush disk
+    idx_array = None
+    error_array = None
+    dirtyLUT = None
 
-                if i ==0: # in first loop, pixels !=i should be replaced by param_array values, as result_array doesn't exist yet
-                    print("result_array gets values {}".format(param[i][0]))
-                    result_array = np.where(param_array[counter]==i, param[i][0], param_array[counter])
+    #use the indexes to retrieve the actual parameter values for each pixel from the LUT indexes
+    # since the values are assumed equal in all vertical layers (side_lengths and density) or only the top layer (LAPs)
+    # only the first value from the parameter arrays is needed.
 
-                else:
-                    print("result_array gets values {}".format(param[i][0]))
-                    result_array = np.where(param_array[counter]==i, param[i][0], result_array)
+    param_names = ['side_lengths','densities','dust','algae']
+    results = {}
 
-            # reshape to original dims, add metadata, convert to xr DataArray, apply mask
-            result_array = result_array.reshape(int(np.sqrt(len(stackedT))),int(np.sqrt(len(stackedT))))
-            resultxr = xr.DataArray(data=result_array,dims=['y','x'], coords={'x':S2vals.x, 'y':S2vals.y}).chunk(2000,2000)
-            
-            print("PROCESSED RESULT ARRAY: \n")
-            print(resultxr.values)
+    for counter, param in enumerate([side_lengths, densities, dust, algae]):
 
-            # PREVENT ALGAL/DUST OVERESTIMATE IN WATER/CC/SN PIXELS ##
-            resultxr = resultxr.where(mask2>0)
+        # map LUT indexes to parameter values with a single gather from a lookup table and
+        # scatter them back into the image, leaving masked pixels (water, cloud, snow) as NaN
+        table = np.array([level[0] for level in param], dtype=np.float32)
+        result_array = np.full(valid.shape, np.nan, dtype=np.float32)
+        result_array[valid] = table[param_array[counter]]
 
-            print(result_array)
+        # reshape to original dims, add metadata, convert to xr DataArray
+        result_array = result_array.reshape(S2vals.sizes['y'], S2vals.sizes['x'])
+        resultxr = xr.DataArray(data=result_array,dims=['y','x'], coords={'x':S2vals.x, 'y':S2vals.y}).chunk({'y': 2000, 'x': 2000})
 
-            # send to netcdf and flush memory
-            resultxr.to_netcdf(str(os.environ['PROCESS_DIR']+ "{}.nc".format(param_names[counter])))
-            
-            result_array = None
-            resultxr = None
-            counter +=1
+        results[param_names[counter]] = resultxr
 
-        
-        # retrieved params are saved as temporary netcdfs to the process_dir and then collated directly from 
-        # file into the final dataset in run_classifier.py
+        result_array = None
+        resultxr = None
+
+    # send all four params to one netcdf (one file open, one write) and flush memory
+    encoding = {name: {'zlib': True, 'complevel': 1, 'chunksizes': (2000, 2000)} for name in param_names}
+    xr.Dataset(results).to_netcdf(str(os.environ['PROCESS_DIR'] + 'snicar_params.nc'), encoding=encoding)
+    results = None
+
+    # retrieved params are saved as a temporary netcdf to the process_dir and then collated directly from 
+    # file into the final dataset in run_classifier.py
     return
 
 
 def format_retrieved_params(S2xr):
 
-    side_length = xr.load_dataarray(str(os.environ['PROCESS_DIR'] + 'side_lengths.nc'))
-    density = xr.load_dataarray(str(os.environ['PROCESS_DIR'] + 'densities.nc'))
-    dust = xr.load_dataarray(str(os.environ['PROCESS_DIR'] + 'dust.nc'))
-    algae = xr.load_dataarray(str(os.environ['PROCESS_DIR'] + 'algae.nc'))
+    params = xr.load_dataset(str(os.environ['PROCESS_DIR'] + 'snicar_params.nc'))
 
-    
     dataset = xr.Dataset({
-        'side_length': (['x', 'y'], side_length.values),
-        'density': (['x', 'y'], density.values),
-        'dust': (['x', 'y'], dust.values),
-        'algae': (['x', 'y'], algae.values)},
+        'side_length': (['x', 'y'], params.side_lengths.values),
+        'density': (['x', 'y'], params.densities.values),
+        'dust': (['x', 'y'], params.dust.values),
+        'algae': (['x', 'y'], params.algae.values)},
         coords={'x': S2xr.x, 'y': S2xr.y})
 
     return dataset
 
 
+# parameter grids SNICAR_LUT_2058.npy was generated over, in LUT axis order (7 x 7 x 6 x 7 = 2058 spectra).
+# The SNICAR LUT is built outside this repo, so these must be kept in step with it by hand.
+side_lengths = [[500,500,500,500,500],[700,700,700,700,700],[900,900,900,900,900],[1100,1100,1100,1100,1100],
+                [1500,1500,1500,1500,1500],[3000,3000,3000,3000,3000],[5000,5000,5000,5000,5000]]
+
+densities = [[400,400,400,400,400],[500,500,500,500,500],[600,600,600,600,600],[700,700,700,700,700],
+             [800,800,800,800,800],[850,850,850,850,850],[900,900,900,900,900]]
+
+dust = [[0,0,0,0,0],[10000,0,0,0,0],[50000,0,0,0,0],[100000,0,0,0,0],[250000,0,0,0,0],[500000,0,0,0,0]]
+
+algae = [[0,0,0,0,0],[5000,0,0,0,0],[10000,0,0,0,0],[50000,0,0,0,0],[100000,0,0,0,0],[150000,0,0,0,0],
+         [200000,0,0,0,0]]
+
+# SNICAR wavelengths and the positions of the 9 S2 bands in them, as for invert_disort in run_classifier.py
+wavelengths = np.arange(0.3,5,0.01)
+
+idx = [19, 26, 36, 40, 44, 48, 56, 131, 190]
+
 with xr.open_dataset("/home/joe/Code/BioSNICAR_GO_PY/S2vals.nc",chunks={'x':2000,'y':2000}) as S2xr:
 
-    invert_snicar(S2xr)
+    # combined ice/cloud/no-data mask, as Ice_Surface_Analyser.SurfaceClassifier.combine_masks
+    mask2 = (S2xr.Icemask.values == 1) & (S2xr.Data.isel(bands=0).values > 0) & (S2xr.Cloudmask.values == 0)
+
+    invert_snicar(S2xr, mask2, side_lengths, densities, dust, algae, wavelengths, idx)
     dataset = format_retrieved_params(S2xr)
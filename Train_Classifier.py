@@ -85,23 +85,86 @@ The final function calculates spatial statistics for the classified surface and
 ###########################################################################################
 ############################# IMPORT MODULES #########################################
 
+import os
+import pickle
+import hashlib
 import numpy as np
 import pandas as pd
 from sklearn import model_selection
-from sklearn.metrics import confusion_matrix, recall_score, f1_score, precision_score
-from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import confusion_matrix
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
 import matplotlib as mpl
+mpl.use('Agg')
 import matplotlib.pyplot as plt
-from sklearn.externals import joblib
-import sklearn_xarray
-import xarray as xr
-import seaborn as sn
+from matplotlib.collections import LineCollection
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
 
-# matplotlib settings: use ggplot style and turn interactive mode off so that plots can be saved and not shown (for
-# rapidly processing multiple images later)
+# matplotlib settings: use ggplot style. Figures are only ever saved, never shown, so the non-interactive Agg backend
+# is selected before pyplot is imported (above) and no GUI toolkit is loaded
 
 mpl.style.use('ggplot')
-plt.ioff()
+
+
+# Group site names according to surface class. Defined once at import as tuples; create_dataset
+# takes each class's columns from the HCRF table with these names
+
+HAsites = ('13_7_SB2', '13_7_SB4', '14_7_S5', '14_7_SB1', '14_7_SB5', '14_7_SB10',
+           '15_7_SB3', '21_7_SB1', '21_7_SB7', '22_7_SB4', '22_7_SB5', '22_7_S3', '22_7_S5',
+           '23_7_SB3', '23_7_SB5', '23_7_S3', '23_7_SB4', '24_7_SB2', 'HA_1', 'HA_2', 'HA_3',
+           'HA_4', 'HA_5', 'HA_6', 'HA_7', 'HA_8', 'HA_10', 'HA_11', 'HA_12', 'HA_13', 'HA_14',
+           'HA_15', 'HA_16', 'HA_17', 'HA_18', 'HA_19', 'HA_20', 'HA_21', 'HA_22', 'HA_24',
+           'HA_25', 'HA_26', 'HA_27', 'HA_28', 'HA_29', 'HA_30', 'HA_31', '13_7_S2', '14_7_SB9',
+           'MA_11', 'MA_14', 'MA_15', 'MA_17', '21_7_SB2', '22_7_SB1', 'MA_4', 'MA_7', 'MA_18',
+           '27_7_16_SITE3_WMELON1', '27_7_16_SITE3_WMELON3', '27_7_16_SITE2_ALG1',
+           '27_7_16_SITE2_ALG2', '27_7_16_SITE2_ALG3', '27_7_16_SITE2_ICE3', '27_7_16_SITE2_ICE5',
+           '27_7_16_SITE3_ALG4', '5_8_16_site2_ice7', '5_8_16_site3_ice2', '5_8_16_site3_ice3',
+           '5_8_16_site3_ice5', '5_8_16_site3_ice6', '5_8_16_site3_ice7', '5_8_16_site3_ice8',
+           '5_8_16_site3_ice9','2018-07-24_D1', '2018-07-24_D2', '2018-07-24_D3', '2018-07-24_D4',
+           '2018-07-24_D5')
+
+LAsites = ('14_7_S2', '14_7_S3', '14_7_SB2', '14_7_SB3', '14_7_SB7', '15_7_S2',
+           '15_7_SB4', '20_7_SB1', '20_7_SB3', '21_7_S1', '21_7_S5', '21_7_SB4', '22_7_SB2',
+           '22_7_SB3', '22_7_S1', '23_7_S1', '23_7_S2', '24_7_S2', 'MA_1', 'MA_2', 'MA_3',
+           'MA_5', 'MA_6', 'MA_8', 'MA_9', 'MA_10', 'MA_12', 'MA_13', 'MA_16', 'MA_19',
+           '13_7_S1', '13_7_S3', '14_7_S1', '15_7_S1', '15_7_SB2', '20_7_SB2', '21_7_SB5',
+           '21_7_SB8', '25_7_S3', '5_8_16_site2_ice10', '5_8_16_site2_ice5',
+           '5_8_16_site2_ice9', '27_7_16_SITE3_WHITE3', '2018-07-24_D6')
+
+CIsites = ('21_7_S4', '13_7_SB3', '15_7_S4', '15_7_SB1', '15_7_SB5', '21_7_S2',
+           '21_7_SB3', '22_7_S2', '22_7_S4', '23_7_SB1', '23_7_SB2', '23_7_S4',
+           'WI_1', 'WI_2', 'WI_4', 'WI_5', 'WI_6', 'WI_7', 'WI_9', 'WI_10', 'WI_11',
+           'WI_12', 'WI_13', '27_7_16_SITE3_WHITE1', '27_7_16_SITE3_WHITE2',
+           '27_7_16_SITE2_ICE2', '27_7_16_SITE2_ICE4', '27_7_16_SITE2_ICE6',
+           '5_8_16_site2_ice1', '5_8_16_site2_ice2', '5_8_16_site2_ice3',
+           '5_8_16_site2_ice4', '5_8_16_site2_ice6', '5_8_16_site2_ice8',
+           '5_8_16_site3_ice1', '5_8_16_site3_ice4', 
+            'fox11_25_',	'fox11_2_', 'fox11_7_', 'fox11_8_', 'fox13_1b_', 'fox13_2_',
+            'fox13_2a_', 'fox13_2b_', 'fox13_3_', 'fox13_3a_',
+           'fox13_3b_', 'fox13_6a_', 'fox13_7_', 'fox13_7a_', 'fox13_7b_', 'fox13_8_',	
+           'fox13_8a_', 'fox13_8b_', 'fox14_2b_', 'fox14_3_', 'fox14_3a_', 'fox17_8_',
+           'fox17_8a_', 'fox17_8b_', 'fox17_9b_', 'fox24_17_')
+
+CCsites = ('DISP1', 'DISP2', 'DISP3', 'DISP4', 'DISP5', 'DISP6', 'DISP7', 'DISP8',
+           'DISP9', 'DISP10', 'DISP11', 'DISP12', 'DISP13', 'DISP14', '27_7_16_SITE3_DISP1',
+           '27_7_16_SITE3_DISP3')
+
+WATsites = ('21_7_SB5', '21_7_SB8', 'WAT_1', 'WAT_3', 'WAT_6', 'fox14_8_', 'fox14_8a_', 'fox14_8b_',
+            'fox17_5_', 'fox17_5a_', 'fox17_5b_', 'fox17_5c_', 'fox17_6d_', 'fox17_6e_', 'fox17_6f_',
+            'fox17_9_', 'fox17_m1_', 'fox17_m2_', 'fox17_m3_', 'fox17_m4_', 'fox17_m5_', 'fox21_10_',
+            'fox21_17_', 'fox21_18_', 'fox21_19_', 'fox21_28_', 'fox24_8_', 'fox24_8a_', 'fox24_8b_',
+            'fox11_16_', 'fox11_17_', 'fox11_18_','fox11_19_', 'fox11_1_','fox11_20_',)
+
+SNsites = ('14_7_S4', '14_7_SB6', '14_7_SB8', '17_7_SB2', '27_7_16_KANU_', '27_7_16_SITE2_1',
+           '5_8_16_site1_snow10', '5_8_16_site1_snow2', '5_8_16_site1_snow3',
+           '5_8_16_site1_snow4', '5_8_16_site1_snow6', '5_8_16_site1_snow7',
+           '5_8_16_site1_snow9', '2018-07-24_D8', '2018-07-24_D9', '2018-07-24_D7', '2018-07-24_T1',
+           '2018-07-23_D1', '2018-07-23_D2', '2018-07-23_D3', '2018-07-23_D4', '2018-07-23_D5', '2018-07-23_T1',
+           '2018-07-23_T2', '2018-07-23_T3', '2018-07-23_T4', '2018-07-23_T5',
+           'fox15_4_', 'fox15_4a_', 'fox15_4b_', 'fox15_5_', 'fox15_5a_', 'fox15_5b_', 'fox15_7a_', 'fox15_7b_',
+           'fox15_8a_', 'fox15_F7_', 'fox17_3a_', 'fox17_3b_', 'fox17_6_', 'fox17_6a_', 'fox17_6b_', 'fox17_6c_')
 
 
 # DEFINE FUNCTIONS
@@ -113,271 +176,223 @@ def set_paths():
     return hcrf_file, savefig_path
 
 
+def figure_is_current(savefile, fingerprint):
+
+    # True if savefile exists and was drawn from data with the given fingerprint, which is kept in a
+    # .sha file next to the figure, so an identical figure does not have to be drawn and encoded again
+
+    sidecar = savefile + '.sha'
+
+    if os.path.exists(savefile) and os.path.exists(sidecar):
+        with open(sidecar) as f:
+            return f.read() == fingerprint
+
+    return False
+
+
+def record_figure(savefile, fingerprint):
+
+    # stores the fingerprint of the data savefile was just drawn from (see figure_is_current)
+
+    with open(savefile + '.sha', 'w') as f:
+        f.write(fingerprint)
+
+    return
+
+
 def create_dataset(hcrf_file, save_spectra):
 
-    # ground reflectance dataset
-    # Read in raw HCRF data to DataFrame. This version pulls in HCRF data from 2016 and 2017
-    hcrf_master = pd.read_csv(hcrf_file)
-    HA_hcrf = pd.DataFrame()
-    LA_hcrf = pd.DataFrame()
-    CI_hcrf = pd.DataFrame()
-    CC_hcrf = pd.DataFrame()
-    WAT_hcrf = pd.DataFrame()
-    SN_hcrf = pd.DataFrame()
-
-    # Group site names according to surface class
-
-    HAsites = ['13_7_SB2', '13_7_SB4', '14_7_S5', '14_7_SB1', '14_7_SB5', '14_7_SB10',
-               '15_7_SB3', '21_7_SB1', '21_7_SB7', '22_7_SB4', '22_7_SB5', '22_7_S3', '22_7_S5',
-               '23_7_SB3', '23_7_SB5', '23_7_S3', '23_7_SB4', '24_7_SB2', 'HA_1', 'HA_2', 'HA_3',
-               'HA_4', 'HA_5', 'HA_6', 'HA_7', 'HA_8', 'HA_10', 'HA_11', 'HA_12', 'HA_13', 'HA_14',
-               'HA_15', 'HA_16', 'HA_17', 'HA_18', 'HA_19', 'HA_20', 'HA_21', 'HA_22', 'HA_24',
-               'HA_25', 'HA_26', 'HA_27', 'HA_28', 'HA_29', 'HA_30', 'HA_31', '13_7_S2', '14_7_SB9',
-               'MA_11', 'MA_14', 'MA_15', 'MA_17', '21_7_SB2', '22_7_SB1', 'MA_4', 'MA_7', 'MA_18',
-               '27_7_16_SITE3_WMELON1', '27_7_16_SITE3_WMELON3', '27_7_16_SITE2_ALG1',
-               '27_7_16_SITE2_ALG2', '27_7_16_SITE2_ALG3', '27_7_16_SITE2_ICE3', '27_7_16_SITE2_ICE5',
-               '27_7_16_SITE3_ALG4', '5_8_16_site2_ice7', '5_8_16_site3_ice2', '5_8_16_site3_ice3',
-               '5_8_16_site3_ice5', '5_8_16_site3_ice6', '5_8_16_site3_ice7', '5_8_16_site3_ice8',
-               '5_8_16_site3_ice9','2018-07-24_D1', '2018-07-24_D2', '2018-07-24_D3', '2018-07-24_D4',
-               '2018-07-24_D5']
-
-    LAsites = ['14_7_S2', '14_7_S3', '14_7_SB2', '14_7_SB3', '14_7_SB7', '15_7_S2',
-               '15_7_SB4', '20_7_SB1', '20_7_SB3', '21_7_S1', '21_7_S5', '21_7_SB4', '22_7_SB2',
-               '22_7_SB3', '22_7_S1', '23_7_S1', '23_7_S2', '24_7_S2', 'MA_1', 'MA_2', 'MA_3',
-               'MA_5', 'MA_6', 'MA_8', 'MA_9', 'MA_10', 'MA_12', 'MA_13', 'MA_16', 'MA_19',
-               '13_7_S1', '13_7_S3', '14_7_S1', '15_7_S1', '15_7_SB2', '20_7_SB2', '21_7_SB5',
-               '21_7_SB8', '25_7_S3', '5_8_16_site2_ice10', '5_8_16_site2_ice5',
-               '5_8_16_site2_ice9', '27_7_16_SITE3_WHITE3', '2018-07-24_D6']
-
-    CIsites = ['21_7_S4', '13_7_SB3', '15_7_S4', '15_7_SB1', '15_7_SB5', '21_7_S2',
-               '21_7_SB3', '22_7_S2', '22_7_S4', '23_7_SB1', '23_7_SB2', '23_7_S4',
-               'WI_1', 'WI_2', 'WI_4', 'WI_5', 'WI_6', 'WI_7', 'WI_9', 'WI_10', 'WI_11',
-               'WI_12', 'WI_13', '27_7_16_SITE3_WHITE1', '27_7_16_SITE3_WHITE2',
-               '27_7_16_SITE2_ICE2', '27_7_16_SITE2_ICE4', '27_7_16_SITE2_ICE6',
-               '5_8_16_site2_ice1', '5_8_16_site2_ice2', '5_8_16_site2_ice3',
-               '5_8_16_site2_ice4', '5_8_16_site2_ice6', '5_8_16_site2_ice8',
-               '5_8_16_site3_ice1', '5_8_16_site3_ice4', 
-                'fox11_25_',	'fox11_2_', 'fox11_7_', 'fox11_8_', 'fox13_1b_', 'fox13_2_',
-                'fox13_2a_', 'fox13_2b_', 'fox13_3_', 'fox13_3a_',
-               'fox13_3b_', 'fox13_6a_', 'fox13_7_', 'fox13_7a_', 'fox13_7b_', 'fox13_8_',	
-               'fox13_8a_', 'fox13_8b_', 'fox14_2b_', 'fox14_3_', 'fox14_3a_', 'fox17_8_',
-               'fox17_8a_', 'fox17_8b_', 'fox17_9b_', 'fox24_17_']
-
-    CCsites = ['DISP1', 'DISP2', 'DISP3', 'DISP4', 'DISP5', 'DISP6', 'DISP7', 'DISP8',
-               'DISP9', 'DISP10', 'DISP11', 'DISP12', 'DISP13', 'DISP14', '27_7_16_SITE3_DISP1',
-               '27_7_16_SITE3_DISP3']
-
-    WATsites = ['21_7_SB5', '21_7_SB8', 'WAT_1', 'WAT_3', 'WAT_6', 'fox14_8_', 'fox14_8a_', 'fox14_8b_',
-                'fox17_5_', 'fox17_5a_', 'fox17_5b_', 'fox17_5c_', 'fox17_6d_', 'fox17_6e_', 'fox17_6f_',
-                'fox17_9_', 'fox17_m1_', 'fox17_m2_', 'fox17_m3_', 'fox17_m4_', 'fox17_m5_', 'fox21_10_',
-                'fox21_17_', 'fox21_18_', 'fox21_19_', 'fox21_28_', 'fox24_8_', 'fox24_8a_', 'fox24_8b_',
-                'fox11_16_', 'fox11_17_', 'fox11_18_','fox11_19_', 'fox11_1_','fox11_20_',]
-
-    SNsites = ['14_7_S4', '14_7_SB6', '14_7_SB8', '17_7_SB2', '27_7_16_KANU_', '27_7_16_SITE2_1',
-               '5_8_16_site1_snow10', '5_8_16_site1_snow2', '5_8_16_site1_snow3',
-               '5_8_16_site1_snow4', '5_8_16_site1_snow6', '5_8_16_site1_snow7',
-               '5_8_16_site1_snow9', '2018-07-24_D8', '2018-07-24_D9', '2018-07-24_D8', '2018-07-24_D7', '2018-07-24_T1',
-               '2018-07-23_D1', '2018-07-23_D2', '2018-07-23_D3', '2018-07-23_D4', '2018-07-23_D5', '2018-07-23_T1',
-               '2018-07-23_T2', '2018-07-23_T3', '2018-07-23_T4', '2018-07-23_T5',
-               'fox15_4_', 'fox15_4a_', 'fox15_4b_', 'fox15_5_', 'fox15_5a_', 'fox15_5b_', 'fox15_7a_', 'fox15_7b_',
-               'fox15_8a_', 'fox15_F7_', 'fox17_3a_', 'fox17_3b_', 'fox17_6_', 'fox17_6a_', 'fox17_6b_', 'fox17_6c_']
-
-
-              
-
-    # Create dataframes for ML algorithm
-
-    for i in HAsites:
-        hcrf_HA = np.array(hcrf_master[i])
-        HA_hcrf['{}'.format(i)] = hcrf_HA
-
-    for ii in LAsites:
-        hcrf_LA = np.array(hcrf_master[ii])
-        LA_hcrf['{}'.format(ii)] = hcrf_LA
-
-    for iii in CIsites:
-        hcrf_CI = np.array(hcrf_master[iii])
-        CI_hcrf['{}'.format(iii)] = hcrf_CI
-
-    for iv in CCsites:
-        hcrf_CC = np.array(hcrf_master[iv])
-        CC_hcrf['{}'.format(iv)] = hcrf_CC
-
-    for v in WATsites:
-        hcrf_WAT = np.array(hcrf_master[v])
-        WAT_hcrf['{}'.format(v)] = hcrf_WAT
-
-    for vi in SNsites:
-        hcrf_SN = np.array(hcrf_master[vi])
-        SN_hcrf['{}'.format(vi)] = hcrf_SN
+    # select wavelengths to use - currently set to 9 Sentinel 2 bands
+    wavelengths = [140, 210, 315, 355, 390, 433, 515, 1260, 1840]
+    classes = [(HAsites, 6), (LAsites, 5), (CIsites, 4), (CCsites, 3), (WATsites, 2), (SNsites, 1)]
+
+    # The features depend only on the csv and the site lists, so they are cached alongside a key made from the
+    # csv modification time, the sites and the wavelengths. While the key matches (and no spectra plot is asked
+    # for) the cached features are used and the csv is not read at all
+    key = hashlib.sha1(repr((os.path.getmtime(hcrf_file), classes, wavelengths)).encode()).hexdigest()
+    feature_cache = str(savefig_path + 'training_features.npz')
+    features = None
+
+    # the spectra figure is drawn from the same data, so it is only redrawn when the key changes
+    spectra_file = str(savefig_path + "training_spectra.jpg")
+    save_spectra = save_spectra and not figure_is_current(spectra_file, key)
+
+    if not save_spectra and os.path.exists(feature_cache):
+        with np.load(feature_cache) as cached:
+            if str(cached['key']) == key:
+                features, labels = cached['features'], cached['labels']
+
+    if features is None:
+
+        # ground reflectance dataset
+        # Read in raw HCRF data to DataFrame. This version pulls in HCRF data from 2016 and 2017
+        # Only the sites in the class tuples are read, as float32 (reflectance is in 0-1 and the forest works in
+        # float32 anyway). The parsed table is cached as a pickle next to the csv and reused until the csv
+        # is modified or a site is added to the lists, so re-runs while tuning the model skip parsing the csv
+        sites = list(dict.fromkeys(HAsites + LAsites + CIsites + CCsites + WATsites + SNsites))
+        cache = hcrf_file + '.pkl'
+        hcrf_master = None
+
+        if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(hcrf_file):
+            hcrf_master = pd.read_pickle(cache)
+
+            if not set(sites).issubset(hcrf_master.columns):
+                hcrf_master = None
+
+        if hcrf_master is None:
+            hcrf_master = pd.read_csv(hcrf_file, usecols=sites, dtype=np.float32)
+            hcrf_master.to_pickle(cache)
 
         # plot spectra
 
-    if save_spectra:
-
-        WL = np.arange(350, 2500, 1)
-
-        fig = plt.figure(figsize=(10, 10))
-        ax1 = fig.add_subplot(321)
-        ax1.plot(WL, HA_hcrf), plt.xlim(350, 1400), plt.ylim(0, 1.2), plt.title('HA'), plt.xlabel(
-            'Wavelength (nm)'), plt.ylabel('HCRF')
-        ax1.set_title('Hbio')
-        ax2 = fig.add_subplot(322)
-        ax2.plot(WL, LA_hcrf), plt.xlim(350, 1400), plt.ylim(0, 1.2), plt.title('LA'), plt.xlabel(
-            'Wavelength (nm)'), plt.ylabel('HCRF')
-        ax2.set_title('Lbio')
-        ax3 = fig.add_subplot(323)
-        ax3.plot(WL, CI_hcrf), plt.xlim(350, 1400), plt.ylim(0, 1.2), plt.title('LA'), plt.xlabel(
-            'Wavelength (nm)'), plt.ylabel('HCRF')
-        ax3.set_title('Clean ice')
-        ax4 = fig.add_subplot(324)
-        ax4.plot(WL, CC_hcrf), plt.xlim(350, 1400), plt.ylim(0, 1.2), plt.title('LA'), plt.xlabel(
-            'Wavelength (nm)'), plt.ylabel('HCRF')
-        ax4.set_title('Cryoconite')
-        ax5 = fig.add_subplot(325)
-        ax5.plot(WL, WAT_hcrf), plt.xlim(350, 1400), plt.ylim(0, 1.2), plt.title('LA'), plt.xlabel(
-            'Wavelength (nm)'), plt.ylabel('HCRF')
-        ax5.set_title('Water')
-        ax6 = fig.add_subplot(326)
-        ax6.plot(WL, SN_hcrf), plt.xlim(350, 1400), plt.ylim(0, 1.2), plt.title('LA'), plt.xlabel(
-            'Wavelength (nm)'), plt.ylabel('HCRF')
-        ax6.set_title('Snow')
-        plt.tight_layout()
-
-        plt.savefig(str(savefig_path + "training_spectra.jpg"))
-        plt.close()
-
-    # Make dataframe with column for label, columns for reflectance at key wavelengths
-    # select wavelengths to use - currently set to 9 Sentinel 2 bands
+        if save_spectra:
+
+            # one (wavelength, site) numpy array per class, taking all the sites of each class in one slice
+            HA_hcrf = hcrf_master.loc[:, list(HAsites)].to_numpy()
+            LA_hcrf = hcrf_master.loc[:, list(LAsites)].to_numpy()
+            CI_hcrf = hcrf_master.loc[:, list(CIsites)].to_numpy()
+            CC_hcrf = hcrf_master.loc[:, list(CCsites)].to_numpy()
+            WAT_hcrf = hcrf_master.loc[:, list(WATsites)].to_numpy()
+            SN_hcrf = hcrf_master.loc[:, list(SNsites)].to_numpy()
+
+            WL = np.arange(350, 2500, 1)
+
+            # only 350-1400 nm is shown, so only those rows are drawn
+            shown = WL <= 1400
+            colours = plt.rcParams['axes.prop_cycle'].by_key()['color']
+
+            fig, axes = plt.subplots(3, 2, figsize=(10, 10))
+
+            for ax, hcrf, title in zip(axes.ravel(), [HA_hcrf, LA_hcrf, CI_hcrf, CC_hcrf, WAT_hcrf, SN_hcrf],
+                                       ['Hbio', 'Lbio', 'Clean ice', 'Cryoconite', 'Water', 'Snow']):
+
+                # all the spectra of a class as one rasterized collection rather than one line per site
+                spectra = hcrf[shown].T
+                segments = np.stack([np.broadcast_to(WL[shown], spectra.shape), spectra], axis=-1)
+                ax.add_collection(LineCollection(segments, colors=colours, rasterized=True))
+
+                ax.set_xlim(350, 1400), ax.set_ylim(0, 1.2)
+                ax.set_xlabel('Wavelength (nm)'), ax.set_ylabel('HCRF')
+                ax.set_title(title)
+
+            plt.tight_layout()
+
+            # a diagnostic figure, so a lower jpg quality is fine
+            plt.savefig(spectra_file, pil_kwargs={'quality': 70, 'optimize': True})
+            plt.close()
+
+            record_figure(spectra_file, key)
+
+        # Make dataframe with column for label, columns for reflectance at key wavelengths
+        # The reflectance at those wavelengths is gathered for every site of every class in a single fancy index
+        # into the HCRF table (one row per site, classes in label order 6 to 1) and wrapped in a DataFrame at the end
 
-    X = pd.DataFrame()
-
-    X['R140'] = np.array(HA_hcrf.iloc[140])
-    X['R210'] = np.array(HA_hcrf.iloc[210])
-    X['R315'] = np.array(HA_hcrf.iloc[315])
-    X['R355'] = np.array(HA_hcrf.iloc[355])
-    X['R390'] = np.array(HA_hcrf.iloc[390])
-    X['R433'] = np.array(HA_hcrf.iloc[433])
-    X['R515'] = np.array(HA_hcrf.iloc[515])
-    X['R1260'] = np.array(HA_hcrf.iloc[1260])
-    X['R1840'] = np.array(HA_hcrf.iloc[1840])
-
-    X['label'] = 6
-
-    Y = pd.DataFrame()
-    Y['R140'] = np.array(LA_hcrf.iloc[140])
-    Y['R210'] = np.array(LA_hcrf.iloc[210])
-    Y['R315'] = np.array(LA_hcrf.iloc[315])
-    Y['R355'] = np.array(LA_hcrf.iloc[355])
-    Y['R390'] = np.array(LA_hcrf.iloc[390])
-    Y['R433'] = np.array(LA_hcrf.iloc[433])
-    Y['R515'] = np.array(LA_hcrf.iloc[515])
-    Y['R1260'] = np.array(LA_hcrf.iloc[1260])
-    Y['R1840'] = np.array(LA_hcrf.iloc[1840])
-
-    Y['label'] = 5
-
-    Z = pd.DataFrame()
-
-    Z['R140'] = np.array(CI_hcrf.iloc[140])
-    Z['R210'] = np.array(CI_hcrf.iloc[210])
-    Z['R315'] = np.array(CI_hcrf.iloc[315])
-    Z['R355'] = np.array(CI_hcrf.iloc[355])
-    Z['R390'] = np.array(CI_hcrf.iloc[390])
-    Z['R433'] = np.array(CI_hcrf.iloc[433])
-    Z['R515'] = np.array(CI_hcrf.iloc[515])
-    Z['R1260'] = np.array(CI_hcrf.iloc[1260])
-    Z['R1840'] = np.array(CI_hcrf.iloc[1840])
-
-    Z['label'] = 4
-
-    P = pd.DataFrame()
-
-    P['R140'] = np.array(CC_hcrf.iloc[140])
-    P['R210'] = np.array(CC_hcrf.iloc[210])
-    P['R315'] = np.array(CC_hcrf.iloc[315])
-    P['R355'] = np.array(CC_hcrf.iloc[355])
-    P['R390'] = np.array(CC_hcrf.iloc[390])
-    P['R433'] = np.array(CC_hcrf.iloc[433])
-    P['R515'] = np.array(CC_hcrf.iloc[515])
-    P['R1260'] = np.array(CC_hcrf.iloc[1260])
-    P['R1840'] = np.array(CC_hcrf.iloc[1840])
-
-    P['label'] = 3
-
-    Q = pd.DataFrame()
-    Q['R140'] = np.array(WAT_hcrf.iloc[140])
-    Q['R210'] = np.array(WAT_hcrf.iloc[210])
-    Q['R315'] = np.array(WAT_hcrf.iloc[315])
-    Q['R355'] = np.array(WAT_hcrf.iloc[355])
-    Q['R390'] = np.array(WAT_hcrf.iloc[390])
-    Q['R433'] = np.array(WAT_hcrf.iloc[433])
-    Q['R515'] = np.array(WAT_hcrf.iloc[515])
-    Q['R1260'] = np.array(WAT_hcrf.iloc[1260])
-    Q['R1840'] = np.array(WAT_hcrf.iloc[1840])
-
-    Q['label'] = 2
-
-    R = pd.DataFrame()
-    R['R140'] = np.array(SN_hcrf.iloc[140])
-    R['R210'] = np.array(SN_hcrf.iloc[210])
-    R['R315'] = np.array(SN_hcrf.iloc[315])
-    R['R355'] = np.array(SN_hcrf.iloc[355])
-    R['R390'] = np.array(SN_hcrf.iloc[390])
-    R['R433'] = np.array(SN_hcrf.iloc[433])
-    R['R515'] = np.array(SN_hcrf.iloc[515])
-    R['R1260'] = np.array(SN_hcrf.iloc[1260])
-    R['R1840'] = np.array(SN_hcrf.iloc[1840])
-
-    R['label'] = 1
-
-    X = X.append(Y, ignore_index=True)
-    X = X.append(Z, ignore_index=True)
-    X = X.append(P, ignore_index=True)
-    X = X.append(Q, ignore_index=True)
-    X = X.append(R, ignore_index=True)
+        columns = hcrf_master.columns.get_indexer([site for class_sites, label in classes for site in class_sites])
+        features = hcrf_master.to_numpy()[np.ix_(wavelengths, columns)].T
+        labels = np.repeat([label for class_sites, label in classes], [len(class_sites) for class_sites, label in classes])
+
+        np.savez(feature_cache, key=key, features=features, labels=labels)
+
+    X = pd.DataFrame(features, columns=['R{}'.format(wl) for wl in wavelengths])
+    X['label'] = labels
 
     return X
 
+def confusion_scores(conf_mx):
+
+    # returns the accuracy and the support-weighted recall, F1 score and precision (as sklearn's
+    # average='weighted') from a confusion matrix with true classes in rows and predictions in columns.
+    # Classes that are never predicted, or never present, score 0
+
+    tp = np.diag(conf_mx).astype(np.float64)
+    support = conf_mx.sum(axis=1)
+    predicted = conf_mx.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        recall = np.where(support > 0, tp / support, 0)
+        precision = np.where(predicted > 0, tp / predicted, 0)
+        f1 = np.where(recall + precision > 0, 2 * recall * precision / (recall + precision), 0)
+
+    weights = support / support.sum()
+
+    return tp.sum() / conf_mx.sum(), np.sum(weights * recall), np.sum(weights * f1), np.sum(weights * precision)
+
+
+def plot_confusion_matrices(conf_mx, norm_conf_mx, savefile):
+
+    # plots the confusion matrix and the normalised confusion matrix side by side as images with
+    # each cell annotated with its value, and saves the figure to savefile
+
+    # the split is random, so the matrices themselves are the fingerprint: an unchanged figure is not redrawn
+    fingerprint = hashlib.sha1(conf_mx.tobytes() + norm_conf_mx.tobytes()).hexdigest()
+
+    if figure_is_current(savefile, fingerprint):
+        return
+
+    class_labels = ['Snow', 'Water', 'Cryoconite', 'Clean Ice', 'Light Algae', 'Heavy Algae']
+
+    panels = [(conf_mx, plt.cm.Blues, 'frequency', 'Confusion Matrix', '{:d}'),
+              (norm_conf_mx, plt.cm.gray, 'Normalised Error', 'Normalised Confusion Matrix', '{:.2f}')]
+
+    fig, axes = plt.subplots(1, 2, figsize=(10, 5))
+
+    for ax, (mx, cmap, cbar_label, title, fmt) in zip(axes, panels):
+
+        im = ax.imshow(mx, cmap=cmap)
+        fig.colorbar(im, ax=ax, shrink=0.7, label=cbar_label)
+
+        for (i, j), value in np.ndenumerate(mx):
+            # light text on dark cells, dark text on light cells
+            colour = 'w' if np.mean(cmap(im.norm(value))[:3]) < 0.5 else 'k'
+            ax.text(j, i, fmt.format(value), ha='center', va='center', color=colour)
+
+        ax.set_xticks(range(len(class_labels))), ax.set_xticklabels(class_labels, rotation=45)
+        ax.set_yticks(range(len(class_labels))), ax.set_yticklabels(class_labels, rotation=45)
+        ax.grid(False)
+        ax.set_title(title)
+
+    plt.tight_layout()
+    plt.savefig(savefile, dpi=150, bbox_inches='tight')
+    plt.close()
+
+    record_figure(savefile, fingerprint)
+
+    return
+
+
 def split_train_test(X, test_size=0.2, n_trees= 64, print_conf_mx = True, savefigs = False,
-                     show_model_performance = True, pickle_model=False):
+                     show_model_performance = True, pickle_model=False, min_samples_leaf=1, extra_trees=False):
 
-    # Split into test and train datasets
-    features = X.drop(labels=['label'], axis=1)
-    labels = X.filter(items=['label'])
+    # Split into test and train datasets, as plain numpy arrays with the labels as a 1D vector. The split is
+    # stratified so every class, including the small ones (e.g. ~16 cryoconite sites), keeps its share of the
+    # test set
+    features = X.iloc[:, :-1].values
+    labels = X['label'].values
     X_train, X_test, Y_train, Y_test = model_selection.train_test_split(features, labels,
-        test_size=test_size)
-
-    # Convert training and test datasets to DataArrays
-    X_train_xr = xr.DataArray(X_train, dims=('samples','bands'), coords={'bands':features.columns})
-    Y_train_xr = xr.DataArray(Y_train, dims=('samples','label'))
-    X_test_xr = xr.DataArray(X_test, dims=('samples','bands'), coords={'bands':features.columns})
-    Y_test_xr = xr.DataArray(Y_test, dims=('samples','label'))
+        test_size=test_size, stratify=labels)
 
-    # Define classifier
-    clf = sklearn_xarray.wrap(
-        RandomForestClassifier(n_estimators=n_trees, max_leaf_nodes=None, n_jobs=-1),
-        sample_dim='samples', reshapes='bands')
+    # Define classifier, built on all cores. With extra_trees=True the split thresholds are drawn at random
+    # rather than searched for, which typically trains around twice as fast for similar accuracy. Raising
+    # min_samples_leaf gives smaller, faster trees.
+    forest = ExtraTreesClassifier if extra_trees else RandomForestClassifier
+    clf = forest(n_estimators=n_trees, max_features='sqrt', min_samples_leaf=min_samples_leaf,
+                 max_leaf_nodes=None, n_jobs=-1)
 
     # fit classifier to training data
-    clf.fit(X_train_xr, Y_train_xr)
+    clf.fit(X_train, Y_train)
 
     # test model performance on TRAINING SET
-    accuracy_RF_train = clf.score(X_train_xr, Y_train_xr)
-    Y_predict_RF_train = clf.predict(X_train_xr)
-    conf_mx_RF_train = confusion_matrix(Y_train_xr, Y_predict_RF_train)
-    recall_RF_train = recall_score(Y_train_xr, Y_predict_RF_train, average="weighted")
-    f1_RF_train = f1_score(Y_train_xr, Y_predict_RF_train, average="weighted")
-    precision_RF_train = precision_score(Y_train_xr, Y_predict_RF_train, average='weighted')
+    # each set is predicted once, and all the scores are derived from its confusion matrix rather than each
+    # sklearn metric rebuilding the matrix from the predictions
+    Y_predict_RF_train = clf.predict(X_train)
+    conf_mx_RF_train = confusion_matrix(Y_train, Y_predict_RF_train)
+    accuracy_RF_train, recall_RF_train, f1_RF_train, precision_RF_train = confusion_scores(conf_mx_RF_train)
     average_metric_RF_train = (accuracy_RF_train + recall_RF_train + f1_RF_train) / 3
 
     # test model performance on TEST SET
-    accuracy_RF = clf.score(X_test_xr, Y_test_xr)
-    Y_predict_RF = clf.predict(X_test_xr)
-    conf_mx_RF = confusion_matrix(Y_test_xr, Y_predict_RF)
-    recall_RF = recall_score(Y_test_xr, Y_predict_RF, average="weighted")
-    f1_RF = f1_score(Y_test_xr, Y_predict_RF, average="weighted")
-    precision_RF = precision_score(Y_test_xr, Y_predict_RF, average='weighted')
+    Y_predict_RF = clf.predict(X_test)
+    conf_mx_RF = confusion_matrix(Y_test, Y_predict_RF)
+    accuracy_RF, recall_RF, f1_RF, precision_RF = confusion_scores(conf_mx_RF)
     average_metric_RF = (accuracy_RF + recall_RF + f1_RF) / 3
 
     if show_model_performance:
@@ -398,43 +413,14 @@ def split_train_test(X, test_size=0.2, n_trees= 64, print_conf_mx = True, savefi
     norm_conf_mx = conf_mx_RF / row_sums
     np.fill_diagonal(norm_conf_mx, 0)
 
-    # plot confusion matrices as subplots in a single figure using Seaborn heatmap
+    # plot confusion matrices as subplots in a single figure
     if savefigs:
 
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(35, 35))
-        sn.heatmap(conf_mx_RF_train, annot=True, annot_kws={"size": 16},
-                   xticklabels=['Snow', 'Water', 'Cryoconite', 'Clean Ice', 'Light Algae', 'Heavy Algae'],
-                   yticklabels=['Snow', 'Water', 'Cryoconite', 'Clean Ice', 'Light Algae', 'Heavy Algae'],
-                   cbar_kws={"shrink": 0.4, 'label': 'frequency'}, ax=ax1), ax1.tick_params(axis='both', rotation=45)
-        ax1.set_title('Confusion Matrix'), ax1.set_aspect('equal')
-
-        sn.heatmap(norm_conf_mx_train, annot=True, annot_kws={"size": 16}, cmap=plt.cm.gray,
-                   xticklabels=['Snow', 'Water', 'Cryoconite', 'Clean Ice', 'Light Algae', 'Heavy Algae'],
-                   yticklabels=['Snow', 'Water', 'Cryoconite', 'Clean Ice', 'Light Algae', 'Heavy Algae'],
-                   cbar_kws={"shrink": 0.4, 'label': 'Normalised Error'}, ax=ax2), ax2.tick_params(axis='both',
-                                                                                                   rotation=45)
-        ax2.set_title('Normalised Confusion Matrix'), ax2.set_aspect('equal')
-        plt.tight_layout()
-        plt.savefig(str(savefig_path + "final_model_confusion_matrices_trainingset.png"))
-        plt.close()
-
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(35, 35))
-        sn.heatmap(conf_mx_RF, annot=True, annot_kws={"size": 16},
-                   xticklabels=['Snow', 'Water', 'Cryoconite', 'Clean Ice', 'Light Algae', 'Heavy Algae'],
-                   yticklabels=['Snow', 'Water', 'Cryoconite', 'Clean Ice', 'Light Algae', 'Heavy Algae'],
-                   cbar_kws={"shrink": 0.4, 'label': 'frequency'}, ax=ax1), ax1.tick_params(axis='both', rotation=45)
-        ax1.set_title('Confusion Matrix'), ax1.set_aspect('equal')
-
-        sn.heatmap(norm_conf_mx, annot=True, annot_kws={"size": 16}, cmap=plt.cm.gray,
-                   xticklabels=['Snow', 'Water', 'Cryoconite', 'Clean Ice', 'Light Algae', 'Heavy Algae'],
-                   yticklabels=['Snow', 'Water', 'Cryoconite', 'Clean Ice', 'Light Algae', 'Heavy Algae'],
-                   cbar_kws={"shrink": 0.4, 'label': 'Normalised Error'}, ax=ax2), ax2.tick_params(axis='both',
-                                                                                                   rotation=45)
-        ax2.set_title('Normalised Confusion Matrix'), ax2.set_aspect('equal')
-
-        plt.tight_layout()
-        plt.savefig(str(savefig_path + "final_model_confusion_matrices_testset.png"))
-        plt.close()
+        plot_confusion_matrices(conf_mx_RF_train, norm_conf_mx_train,
+                                str(savefig_path + "final_model_confusion_matrices_trainingset.png"))
+
+        plot_confusion_matrices(conf_mx_RF, norm_conf_mx,
+                                str(savefig_path + "final_model_confusion_matrices_testset.png"))
 
     if print_conf_mx:
         print('Final Confusion Matrix')
@@ -446,7 +432,9 @@ def split_train_test(X, test_size=0.2, n_trees= 64, print_conf_mx = True, savefi
     if pickle_model:
         # pickle the classifier model for archiving or for reusing in another code
         joblibfile = str('/home/joe/Code/IceSurfClassifiers/Sentinel_Resources/Sentinel2_classifierTest.pkl')
-        joblib.dump(clf, joblibfile)
+        # zlib-compressed (level 3) with the highest pickle protocol: a much smaller file that is quicker to read
+        # from blob storage. The image classifier caches the extracted forest arrays after the first load.
+        joblib.dump(clf, joblibfile, compress=3, protocol=pickle.HIGHEST_PROTOCOL)
 
         # to load this classifier into another code use the following syntax:
         # clf = joblib.load(joblib_file)
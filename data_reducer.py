@@ -26,11 +26,19 @@ plt.style.use('tableau-colorblind10')
 
 def reduce_outputs(tile, year, dateList, var, savepath):
 
-    ds = xr.open_dataset('/datadrive2/BigIceSurfClassifier/Process_Dir/outputs/{}/FULL_OUTPUT_{}_{}_Final.nc'.format(tile,tile,year))
+    # open in dask chunks (multiples of the 512 x 512 chunks the outputs are written with) so the variable is
+    # streamed from the ~100 GB file to the reduced file chunk by chunk rather than loaded into memory in one go
+    ds = xr.open_dataset('/datadrive2/BigIceSurfClassifier/Process_Dir/outputs/{}/FULL_OUTPUT_{}_{}_Final.nc'.format(tile,tile,year),
+                         chunks={'date': 1, 'y': 2048, 'x': 2048})
 
     ds2 = ds[var].drop_sel(date=dateList)
 
-    ds2.to_netcdf(str(savepath+'REDUCED_' + var + '_' + tile + '_' + year+'.nc'))
+    # write the reduced file compressed in (1, 512, 512) HDF5 chunks, keeping the variable's packed dtype, so the
+    # plotting scripts read whole, small chunks that line up with the dask chunks they open the files with
+    encoding = {var: dict(ds2.encoding, zlib=True, complevel=1, shuffle=True, contiguous=False,
+                          chunksizes=(1, 512, 512))}
+
+    ds2.to_netcdf(str(savepath+'REDUCED_' + var + '_' + tile + '_' + year+'.nc'), encoding=encoding)
 
     ds = None
     ds2 = None
@@ -34,6 +34,7 @@ import json
 import datetime as dt
 import calendar
 import glob
+import fnmatch
 import xarray as xr
 import numpy as np
 import matplotlib.pyplot as plt
@@ -44,6 +45,14 @@ import xr_cf_conventions
 import multiprocessing as mp
 import gc
 
+# GDAL runtime configuration: multithreaded JP2 decoding and a larger block cache. GDAL reads these lazily,
+# so setting them here is early enough. setdefault means values exported in the shell take precedence.
+for gdal_option, value in [('GDAL_NUM_THREADS', 'ALL_CPUS'),
+                           ('GDAL_CACHEMAX', '2048'),
+                           ('VSI_CACHE', 'TRUE'),
+                           ('CPL_VSIL_CURL_ALLOWED_EXTENSIONS', '.jp2')]:
+    os.environ.setdefault(gdal_option, value)
+
 ###################################################################################
 ######## DEFINE BLOB ACCESS, GLOBAL VARIABLES AND SET UP EMPTY LISTS/ARRAYS #######
 ###################################################################################
@@ -65,7 +74,7 @@ isa = Ice_Surface_Analyser.SurfaceClassifier(os.environ['PROCESS_DIR'] + config.
 download_problem_list = []  # empty list to append details of skipped tiles due to missing info
 QC_reject_list = []  # empty list to append details of skipped tiles due to cloud cover
 good_tile_list = []  # empty list to append tiles used in analysis
-masterDF = pd.DataFrame()
+Icemask_cache = {}  # reprojected ice masks, reused for every date on the same tile
 dates = []
 
 # send config data to log file and report to console
@@ -119,6 +128,13 @@ for year in years:
 
 tiles = json.loads(config.get('options', 'tiles'))
 
+# read images straight from blob storage via GDAL's /vsiaz/ instead of downloading them to PROCESS_DIR
+stream_from_blob = config.get('options', 'stream_from_blob', fallback='False') == 'True'
+
+if stream_from_blob:
+    # osgeo and rasterio may not share a GDAL, so the classifier passes the options to its rasterio reads too
+    isa.gdal_options = azure.enable_vsiaz()
+
 for tile in tiles:
 
     tile = tile.lower()  # azure blob store is case sensitive: force lower case
@@ -137,12 +153,16 @@ for tile in tiles:
     # make DirName the path to save files to
     savepath = dirName
 
+    # lat/lon grids are identical for every date on a tile, so they are computed for the first good date only
+    lon = None
+    lat = None
+
     for date in dates:
 
         print("\n DOWNLOADING FILES: {} {}\n".format(tile,date))
 
         #query blob for files in tile and date range
-        filtered_bloblist, download_flag = azure.download_imgs_by_date(tile,date, os.environ['PROCESS_DIR'])
+        img_files, download_flag = azure.download_imgs_by_date(tile, date, os.environ['PROCESS_DIR'], stream=stream_from_blob)
 
         # check download and only proceed if correct no. of files and cloud layer present
 
@@ -154,13 +174,18 @@ for tile in tiles:
         else:
             print("\nChecking cloud, ice and NaN cover")
 
-            Icemask, Cloudmask = sentinel2_tools.format_mask(os.environ['PROCESS_DIR'],
+            Icemask, Cloudmask = sentinel2_tools.format_mask(img_files,
                                                              os.environ['PROCESS_DIR'] + config.get('options',
                                                                                                     'icemask'),
                                                              os.environ['PROCESS_DIR'] + '/outputs/ICE_MASK.nc',
-                                                             int(config.get('thresholds', 'cloudCoverThresh')))
+                                                             int(config.get('thresholds', 'cloudCoverThresh')),
+                                                             Icemask_cache, isa.gdal_options)
+
+            # band 2 is read once here and shared between the QC check and the image loader
+            fileB2 = fnmatch.filter(img_files, '*B02_20m.jp2')[0]
+            B02 = isa.read_band(fileB2)
 
-            QCflag, useable_area = sentinel2_tools.img_quality_control(os.environ['PROCESS_DIR'],
+            QCflag, useable_area = sentinel2_tools.img_quality_control(B02,
                                                                        Icemask, Cloudmask,
                                                                        int(config.get('thresholds', 'minArea')))
 
@@ -177,10 +202,11 @@ for tile in tiles:
                 print("\n NO FLAGS, proceeding with image analysis for {}, {}".format(tile,date))
                 good_tile_list.append('{}_{}_useable_area = {} '.format(tile, date, np.round(useable_area,2)))
 
-                s2xr = isa.load_img_to_xr(os.environ['PROCESS_DIR'],
+                s2xr = isa.load_img_to_xr(img_files,
                                           int(config.get('options', 'resolution')),
                                           Icemask,
-                                          Cloudmask)
+                                          Cloudmask,
+                                          preloaded={fileB2: B02})
 
                 # apply classifier and calculate albedo
                 predicted = isa.classify_image(s2xr, savepath, tile, date, savefigs=True)
@@ -193,18 +219,15 @@ for tile in tiles:
 
                 # 2) Create associated lat/lon coordinates DataArrays using georaster (imports geo metadata without loading img)
                 # see georaster docs at https:/media.readthedocs.org/pdf/georaster/latest/georaster.pdf
-                # find B02 jp2 file
-                fileB2 = glob.glob(str(os.environ['PROCESS_DIR'] + '*{}*B02_20m.jp2').format(tile.upper()))
-                fileB2 = fileB2[0]
-
-                lon, lat = xr_cf_conventions.create_latlon_da(fileB2, 'x', 'y',
-                                                              s2xr.x, s2xr.y, proj_info)
+                # only done once per tile - the grid does not change between dates
+                if lon is None:
+                    lon, lat = xr_cf_conventions.create_latlon_da(fileB2, 'x', 'y',
+                                                                  s2xr.x, s2xr.y, proj_info)
 
                 # 3) add predicted map array and add metadata
 
-                predicted = predicted.fillna(0)
+                # classify_image returns int8 labels (0 where unclassified), so masking gives float32 rather than float64
                 predicted = predicted.where(mask2 > 0)
-                predicted.encoding = {'dtype': 'int16', 'zlib': True, '_FillValue': -9999}
                 predicted.name = 'Surface Class'
                 predicted.attrs['long_name'] = 'Surface classified using Random Forest'
                 predicted.attrs['units'] = 'None'
@@ -215,7 +238,6 @@ for tile in tiles:
 
                 albedo = albedo.fillna(0)
                 albedo = albedo.where(mask2 > 0)
-                albedo.encoding = {'dtype': 'int16', 'scale_factor': 0, 'zlib': True, '_FillValue': -9999}
                 albedo.name = 'Surface albedo computed after Knap et al. (1999) narrowband-to-broadband conversion'
                 albedo.attrs['units'] = 'dimensionless'
                 albedo.attrs['grid_mapping'] = proj_info.attrs['grid_mapping_name']
@@ -225,7 +247,6 @@ for tile in tiles:
 
                 Index2DBA = Index2DBA.fillna(0)
                 Index2DBA = Index2DBA.where(mask2 > 0)
-                Index2DBA.encoding = {'dtype': 'int16', 'scale_factor': 0, 'zlib': True, '_FillValue': -9999}
                 Index2DBA.name = '2DBA band ratio index value (Wang et al. 2018)'
                 Index2DBA.attrs['units'] = 'dimensionless'
                 Index2DBA.attrs['grid_mapping'] = proj_info.attrs['grid_mapping_name']
@@ -234,7 +255,6 @@ for tile in tiles:
 
                 predict2DBA = predict2DBA.fillna(0)
                 predict2DBA = predict2DBA.where(mask2 > 0)
-                predict2DBA.encoding = {'dtype': 'int16', 'scale_factor': 0, 'zlib': True, '_FillValue': -9999}
                 predict2DBA.name = '2DBA band ratio index value (Wang et al. 2018)'
                 predict2DBA.attrs['units'] = 'dimensionless'
                 predict2DBA.attrs['grid_mapping'] = proj_info.attrs['grid_mapping_name']
@@ -266,32 +286,24 @@ for tile in tiles:
 
                     idx = [19, 26, 36, 40, 44, 48, 56, 131, 190]
 
-                    isa.invert_disort(s2xr,mask2,predicted,side_lengths,densities,algae,wavelengths,idx, tile, year, month)
+                    density, side_length, algae = isa.invert_disort(s2xr,mask2,predicted,side_lengths,densities,algae,wavelengths,idx, tile, date, year, month,
+                                                                    search=config.get('options', 'lut_search', fallback='tree'))
 
                     # Add metadata to retrieved disort parameter arrays + mask
-                    with xr.open_dataarray(str(os.environ['PROCESS_DIR'] + 'side_lengths.nc')) as side_length:
+                    side_length.name = "Grain size"
+                    side_length.attrs['long_name'] = 'Grain size in microns. Assumed homogenous to 10 cm depth'
+                    side_length.attrs['units'] = 'Microns'
+                    side_length.attrs['grid_mapping'] = proj_info.attrs['grid_mapping_name']
 
-                        side_length.encoding = {'dtype': 'float16', 'zlib': True, '_FillValue': -9999}
-                        side_length.name = "Grain size"
-                        side_length.attrs['long_name'] = 'Grain size in microns. Assumed homogenous to 10 cm depth'
-                        side_length.attrs['units'] = 'Microns'
-                        side_length.attrs['grid_mapping'] = proj_info.attrs['grid_mapping_name']
-                    
-                    with xr.open_dataarray(str(os.environ['PROCESS_DIR'] + 'densities.nc')) as density:
-
-                        density.encoding = {'dtype': 'float16', 'zlib': True, '_FillValue': -9999}
-                        density.name = "Density"
-                        density.attrs['long_name'] = 'Ice column density in kg m-3. Assumed to be homogenous to 10 cm depth'
-                        density.attrs['units'] = 'Kg m-3'
-                        density.attrs['grid_mapping'] = proj_info.attrs['grid_mapping_name']
-
-                    with xr.open_dataarray(str(os.environ['PROCESS_DIR'] + 'algae.nc')) as algae:
+                    density.name = "Density"
+                    density.attrs['long_name'] = 'Ice column density in kg m-3. Assumed to be homogenous to 10 cm depth'
+                    density.attrs['units'] = 'Kg m-3'
+                    density.attrs['grid_mapping'] = proj_info.attrs['grid_mapping_name']
 
-                        algae.encoding = {'dtype': 'float16', 'zlib': True, '_FillValue': -9999}
-                        algae.name = "Algae"
-                        algae.attrs['long_name'] = 'Ice column algae in kg m-3. Assumed to be homogenous to 10 cm depth'
-                        algae.attrs['units'] = 'Kg m-3'
-                        algae.attrs['grid_mapping'] = proj_info.attrs['grid_mapping_name']
+                    algae.name = "Algae"
+                    algae.attrs['long_name'] = 'Ice column algae in kg m-3. Assumed to be homogenous to 10 cm depth'
+                    algae.attrs['units'] = 'Kg m-3'
+                    algae.attrs['grid_mapping'] = proj_info.attrs['grid_mapping_name']
 
                     # collate data arrays into a dataset
                     dataset = xr.Dataset({
@@ -342,7 +354,24 @@ for tile in tiles:
                 if config.get('options','interpolate_cloud')=='True':
                     dataset = sentinel2_tools.cloud_interpolator(dataset)
 
-                dataset.to_netcdf(savepath + "{}_{}_Classification_and_Albedo_Data.nc".format(tile, date), mode='w', format='NETCDF4_CLASSIC')
+                # compress every variable (complevel 1 is nearly as small as higher levels at a fraction of the write
+                # time) and store it in 512 x 512 chunks so that later reads of a sub-area only decompress that area.
+                # Class labels and masks fit in int8 and albedo in int16 scaled by 1e-4; the rest stay float32.
+                # Every integer variable gets a fill value so that NaNs (e.g. from cloud interpolation) survive the cast.
+                nc_chunks = {'zlib': True, 'complevel': 1, 'chunksizes': (512, 512)}
+                encoding = {'classified': dict(nc_chunks, dtype='int8', _FillValue=-1),
+                            'albedo': dict(nc_chunks, dtype='int16', scale_factor=1e-4, _FillValue=-9999),
+                            'Icemask': dict(nc_chunks, dtype='int8', _FillValue=-1),
+                            'Cloudmask': dict(nc_chunks, dtype='int8', _FillValue=-1),
+                            'FinalMask': dict(nc_chunks, dtype='int8', _FillValue=-1)}
+
+                for var in ['Index2DBA', 'predict2DBA', 'grain_size', 'density', 'algae', 'longitude', 'latitude']:
+                    encoding[var] = dict(nc_chunks, dtype='float32', _FillValue=-9999)
+
+                encoding = {var: enc for var, enc in encoding.items() if var in dataset}
+
+                dataset.to_netcdf(savepath + "{}_{}_Classification_and_Albedo_Data.nc".format(tile, date), mode='w',
+                                  format='NETCDF4_CLASSIC', encoding=encoding)
                 
                 # flush dataset from disk
                 dataset = None
@@ -7,12 +7,15 @@ from collections import OrderedDict
 from sentinelsat import SentinelAPI
 from datetime import date
 from azure.storage.blob import BlockBlobService, PublicAccess
+from azure.common import AzureException
+from osgeo import gdal
 import numpy as np
 import os
 import shutil
 import fnmatch
 import glob
 import gc
+from concurrent.futures import ThreadPoolExecutor
 
 
 class AzureAccess:
@@ -35,6 +38,44 @@ class AzureAccess:
 
 
 
+    def vsiaz_options(self):
+
+        """
+        Returns the GDAL config options for reading blobs through GDAL's /vsiaz/ virtual file system: the account
+        credentials plus larger range requests and HTTP/2 multiplexing, unless those are already configured.
+        :return: dict of GDAL config options
+        """
+
+        options = {'AZURE_STORAGE_ACCOUNT': self._acc_name,
+                   'AZURE_STORAGE_ACCESS_KEY': self._acc_key}
+
+        for gdal_option, value in [('CPL_VSIL_CURL_CHUNK_SIZE', '16777216'),
+                                   ('GDAL_HTTP_MULTIPLEX', 'YES')]:
+            options[gdal_option] = gdal.GetConfigOption(gdal_option) or value
+
+        return options
+
+
+
+    def enable_vsiaz(self):
+
+        """
+        Sets the /vsiaz/ options as osgeo GDAL config options so that images can be streamed straight from blob
+        storage. Only call this when streaming. Config options rather than environment variables keep the key
+        out of child processes. rasterio may bundle its own GDAL (e.g. pip wheels), which does not see these,
+        so rasterio reads must also be wrapped in rasterio.Env(**vsiaz_options()).
+        :return: dict of GDAL config options, for the rasterio reads
+        """
+
+        options = self.vsiaz_options()
+
+        for gdal_option, value in options.items():
+            gdal.SetConfigOption(gdal_option, value)
+
+        return options
+
+
+
     def send_to_blob(self, tile, L1Cpath, check_blobs=False):
 
         """
@@ -201,7 +242,7 @@ class AzureAccess:
 
 
 
-    def download_imgs_by_date(self, tile, date, img_path):
+    def download_imgs_by_date(self, tile, date, img_path, stream=False):
 
         """
         This function downloads subsets of images stored remotely in Azure blobs. The blob name is identical to the
@@ -214,12 +255,13 @@ class AzureAccess:
         downloaded and that one of them is the cloud mask. If not, the flag is printed to the console and the files
         associated with that particular date for that tile are discarded. The tile and date info are appended to a list of
         failed downloads.
+        If stream is True nothing is downloaded: the images are instead returned as GDAL /vsiaz/ paths so that they
+        are read directly from blob storage with ranged GETs, avoiding staging every file on the local disk.
         :param tile: tile ID
         :param date: date of overpass
         :param img_path: path to folder where images and other temp files will be stored
-        :param blob_account_name: account name for azure storage account where blobs are stored
-        :param blob account key: accesskey for blob storage account
-        :return filtered_blob_list: list of files to download
+        :param stream: Boolean, if True return /vsiaz/ paths to the blobs instead of downloading them
+        :return img_files: list of paths to the image files (local or /vsiaz/)
         :return download_flag: Boolean, if True then problem with download, files skipped
         """
 
@@ -246,40 +288,53 @@ class AzureAccess:
         # extraction. I think the loop for 2018, 2019, 2020 will now actually work for all
         # dates but not yet properly tested, so this slightly ugly workaround persists for now.
 
-        if (date[0:4] == '2018') | (date[0:4] == "2019") | (date[0:4] == "2020"):
+        if stream:
 
-            # print(filtered_by_type)
-            print("FILTERED BLOBLIST")
-            print(filtered_bloblist)
+            # GDAL reads the blobs directly through its /vsiaz/ virtual file system
+            img_files = ['/vsiaz/{}/{}'.format(tile, i) for i in filtered_bloblist]
 
-            # download the files in the filtered list
-            for i in filtered_bloblist:
+        else:
 
-                try:
-                    self.block_blob_service.get_blob_to_path(tile,
-                                                i, str(img_path+i[65:-4]+'.jp2'))
-                
-                except:
-                    print("ERROR IN DOWNLOADS")
+            if (date[0:4] == '2018') | (date[0:4] == "2019") | (date[0:4] == "2020"):
 
+                # print(filtered_by_type)
+                print("FILTERED BLOBLIST")
+                print(filtered_bloblist)
 
-        else:
+                local_names = [str(img_path+i[65:-4]+'.jp2') for i in filtered_bloblist]
 
-            # download the files in the filtered list
-            for i in filtered_bloblist:
-                print(i)
-                try:
-                    self.block_blob_service.get_blob_to_path(tile,
-                                                i, str(img_path+i[-38:-4]+'.jp2'))
-                except:
-                    print("download failed {}".format(i))
+            else:
 
                 # index to -38 because this is the filename without paths to folders etc
+                local_names = [str(img_path+i[-38:-4]+'.jp2') for i in filtered_bloblist]
+
+            def download(blob_name, local_name):
+                print(blob_name)
+                try:
+                    # max_connections lets the SDK fetch ranges of each blob in parallel too
+                    self.block_blob_service.get_blob_to_path(tile, blob_name, local_name, max_connections=4)
+                    return True
+                except AzureException as e:
+                    print("download failed {}: {}".format(blob_name, e))
+                    return False
+
+            # download the files in the filtered list. Per-connection blob throughput is latency bound, so
+            # fetching the files concurrently is much faster than one after the other.
+            with ThreadPoolExecutor(max_workers=16) as ex:
+                downloaded = list(ex.map(download, filtered_bloblist, local_names))
+
+            img_files = glob.glob(str(img_path + '*.jp2'))
 
         # Check downloaded files to make sure all bands plus the cloud mask are present in the wdir
         # Raises download flag (Boolean true) and reports to console if there is a problem
 
-        if len(glob.glob(str(img_path + '*_B*_20m.jp2'))) < 9 or len(glob.glob(str(img_path + '*CLD*_20m.jp2'))) == 0:
+        if not stream and not all(downloaded):
+            download_flag = True
+
+            print("\n *** DOWNLOAD QC FLAG RAISED *** \n *** one or more files failed to download, so this date would"
+                  " be classified from a partial set of bands ***")
+
+        elif len(fnmatch.filter(img_files, '*_B*_20m.jp2')) < 9 or len(fnmatch.filter(img_files, '*CLD*_20m.jp2')) == 0:
             download_flag = True
 
             print("\n *** DOWNLOAD QC FLAG RAISED *** \n *** There may have been no overpass on this date, or there is a"
@@ -289,6 +344,6 @@ class AzureAccess:
             download_flag = False
             print("\n *** NO DOWNLOAD QC FLAG RAISED: ALL NECESSARY FILES AVAILABLE IN WDIR ***")
 
-        # relevant files now downloaded from blob and stored in the savepath folder
+        # relevant files now downloaded from blob and stored in the savepath folder (or streamed from the blob)
 
-        return filtered_bloblist, download_flag
\ No newline at end of file
+        return img_files, download_flag
\ No newline at end of file
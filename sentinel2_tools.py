@@ -9,7 +9,9 @@ import sys
 import shutil
 from osgeo import gdal
 import glob
+import fnmatch
 import xarray as xr
+import rasterio
 import numpy as np
 import matplotlib.pyplot as plt
 import datetime as dt
@@ -17,6 +19,7 @@ import matplotlib as mpl
 import configparser
 import pandas as pd
 from scipy import interpolate
+from numba import njit, prange
 import sentinel2_azure
 plt.ioff()
 
@@ -24,6 +27,9 @@ plt.ioff()
 config = configparser.ConfigParser()
 config.read_file(open(sys.argv[1]))
 
+# surface class names indexed by class label (0 = unclassified), used to label the per-class summaries
+class_names = ['NONE', 'SN', 'WAT', 'CC', 'CI', 'LA', 'HA']
+
 
 def download_L1C(api, L1Cpath, tile, dates, cloudcoverthreshold):
     """
@@ -164,7 +170,7 @@ def clear_img_directory(img_path):
 
 
 
-def format_mask(img_path, Icemask_in, Icemask_out, cloudProbThreshold):
+def format_mask(img_files, Icemask_in, Icemask_out, cloudProbThreshold, Icemask_cache=None, gdal_options=None):
 
     """
     Function to format the land/ice and cloud masks.
@@ -176,64 +182,109 @@ def format_mask(img_path, Icemask_in, Icemask_out, cloudProbThreshold):
     Note that from 2016 onwards, the file naming convention changed in the Sentinel archive, with the string "CLD_20m"
     replaced by "CLDPRB_20m". Therefore an additional wildcard * was added to the search term *CLD*_20m.jp2.
 
-    :param img_path: path to image to use as projection template
+    :param img_files: list of paths (local or /vsiaz/) to the image files for this date, used as projection template
     :param Icemask_in: file path to mask file
     :param Icemask_out: file path to save reprojected mask
     :param cloudProbThreshold: threshold probability of cloud for masking pixel
-    :return Icemask: Boolean to mask out pixels outside the ice sheet boundaries
-    :return Cloudmask: Boolean to mask out pixels obscured by cloud
+    :param Icemask_cache: optional dict used to reuse the reprojected ice mask across dates on the same S2 grid
+    :param gdal_options: optional GDAL config options (e.g. /vsiaz/ credentials) for reading the cloud layer with rasterio
+    :return Icemask: uint8 array (1 = ice) to mask out pixels outside the ice sheet boundaries
+    :return Cloudmask: uint8 array (1 = cloud) to mask out pixels obscured by cloud
     """
-    cloudmaskpath_temp = glob.glob(str(img_path + '*CLD*'+'*_20m.jp2')) # find cloud mask layer in filtered S2 image directory
+    cloudmaskpath_temp = fnmatch.filter(img_files, '*CLD*_20m.jp2') # find cloud mask layer in filtered S2 image files
     cloudmaskpath = cloudmaskpath_temp[0]
 
-    mask = gdal.Open(Icemask_in)
-    mask_proj = mask.GetProjection()
-    mask_geotrans = mask.GetGeoTransform()
-    data_type = mask.GetRasterBand(1).DataType
-    n_bands = mask.RasterCount
-
-    S2filename = glob.glob(str(img_path + '*B02_20m.jp2')) # use glob to find files because this allows regex such as * - necessary for iterating through downloads
+    S2filename = fnmatch.filter(img_files, '*B02_20m.jp2') # use fnmatch to find files because this allows wildcards such as * - necessary for iterating through downloads
     Sentinel = gdal.Open(S2filename[0]) # open the glob'd filed in gdal
 
     Sentinel_proj = Sentinel.GetProjection()
     Sentinel_geotrans = Sentinel.GetGeoTransform()
     w = Sentinel.RasterXSize
     h = Sentinel.RasterYSize
+    Sentinel = None
+
+    # the S2 grid is identical for every date on a tile, so the reprojected ice mask only needs
+    # recomputing when the mask file, projection or extent changes
+    fingerprint = (Icemask_in, Sentinel_proj, Sentinel_geotrans, w, h)
 
-    mask_filename = Icemask_out
-    new_mask = gdal.GetDriverByName('GTiff').Create(mask_filename,
-                                                     w, h, n_bands, data_type)
-    new_mask.SetGeoTransform(Sentinel_geotrans)
-    new_mask.SetProjection(Sentinel_proj)
+    if Icemask_cache is not None and fingerprint in Icemask_cache:
+        Icemask = Icemask_cache[fingerprint]
+
+    else:
+        # warp only the window of the Greenland-wide mask covered by the S2 tile, using GDAL's multithreaded
+        # warper. Setting width/height as well as the bounds guarantees the output matches the S2 grid exactly.
+        minx = Sentinel_geotrans[0]
+        maxy = Sentinel_geotrans[3]
+        maxx = minx + w * Sentinel_geotrans[1]
+        miny = maxy + h * Sentinel_geotrans[5]
 
-    gdal.ReprojectImage(mask, new_mask, mask_proj,
-                        Sentinel_proj, gdal.GRA_NearestNeighbour)
+        new_mask = gdal.Warp(Icemask_out, Icemask_in, format='GTiff',
+                             outputBounds=(minx, miny, maxx, maxy), width=w, height=h,
+                             dstSRS=Sentinel_proj, resampleAlg='near',
+                             multithread=True, warpMemoryLimit=512, warpOptions=['NUM_THREADS=ALL_CPUS'],
+                             creationOptions=['TILED=YES', 'COMPRESS=DEFLATE'])
 
-    new_mask = None  # Flush disk
+        new_mask = None  # Flush disk
 
-    maskxr = xr.open_rasterio(Icemask_out)
-    mask_squeezed = xr.DataArray.squeeze(maskxr,'band')
-    Icemask = xr.DataArray(mask_squeezed.values)
+        with xr.open_rasterio(Icemask_out) as maskxr:
+            Icemask = maskxr.squeeze('band').values.astype(np.uint8)
 
-    # set up second mask for clouds
-    Cloudmask = xr.open_rasterio(cloudmaskpath)
-    Cloudmask = xr.DataArray.squeeze(Cloudmask,'band')
-    # set pixels where probability of cloud < threshold to 0
-    Cloudmask = Cloudmask.where(Cloudmask.values >= cloudProbThreshold, 0)
-    Cloudmask = Cloudmask.where(Cloudmask.values < cloudProbThreshold, 1)
+        if Icemask_cache is not None:
+            Icemask_cache[fingerprint] = Icemask
+
+    # set up second mask for clouds: pixels where probability of cloud >= threshold are 1, otherwise 0.
+    # A single uint8 comparison replaces two passes of DataArray.where over the probability layer.
+    with rasterio.Env(**(gdal_options or {})), xr.open_rasterio(cloudmaskpath) as cloudxr:
+        Cloudmask = (cloudxr.squeeze('band').values >= cloudProbThreshold).astype(np.uint8)
 
     return Icemask, Cloudmask
 
 
 
-def img_quality_control(img_path, Icemask, Cloudmask, minimum_useable_area):
+@njit(parallel=True, fastmath=True)
+def _qc_counts(ice, cloud, band):
+    """
+    Single pass over the ice mask, cloud mask and band image counting cloudy, non-ice, NaN and bad pixels.
+    The band image is read with its rows flipped to match the orientation of the masks.
+
+    :return: counts of cloudy, non-ice, NaN and bad (any of the three) pixels
+    """
+
+    h, w = ice.shape
+    c_cloud = 0
+    c_ice = 0
+    c_nan = 0
+    c_bad = 0
+
+    for i in prange(h):
+        for j in range(w):
+            is_cloud = cloud[i, j] == 1
+            is_not_ice = ice[i, j] == 0
+            is_nan = band[h - 1 - i, j] == 0
+
+            if is_cloud:
+                c_cloud += 1
+            if is_not_ice:
+                c_ice += 1
+            if is_nan:
+                c_nan += 1
+            if is_cloud or is_not_ice or is_nan:
+                c_bad += 1
+
+    return c_cloud, c_ice, c_nan, c_bad
+
+
+
+def img_quality_control(B02, Icemask, Cloudmask, minimum_useable_area):
 
     """
     Function assesses image quality and raises flags if the image contains too little ice (i.e. mostly ocean, dry land
     or NaNs) or too much cloud cover.
 
-    :param Icemask: Boolean for masking non-ice areas
-    :param Cloudmask: Boolean for masking out cloudy pixels
+    :param B02: 2D band 2 image (fairly arbitrary choice of band image), already read by the caller so that
+                the JP2 is only decoded once per date
+    :param Icemask: uint8 array for masking non-ice areas
+    :param Cloudmask: uint8 array for masking out cloudy pixels
     :param CloudCoverThreshold: threshold value for % of total pixels obscured by cloud. If over threshold image not used
     :param IceCoverThreshold: threshold value for % of total pixels outside ice sheet boundaries. If over threshold image not used
     :param NaNthreshold: threshold value for % of total pixels comprised by NaNs. If over threshold image not used
@@ -245,33 +296,20 @@ def img_quality_control(img_path, Icemask, Cloudmask, minimum_useable_area):
     
     print("CHECKING DATA QUALITY")
 
-    S2file = glob.glob(str(img_path + '*B02_20m.jp2')) # find band2 image (fairly arbitrary choice of band image)
-
-    with xr.open_rasterio(S2file[0]) as S2array: #open file
-
-        total_pixels = S2array.size
-        S2array = S2array.values # values to array
-        S2array[S2array > 0] = 1 # make binary (i.e all positive values become 1s)
-        S2array = np.squeeze(S2array) # reshape to match ice and cloudmasks (2d)
-        count_nans = total_pixels - np.count_nonzero(S2array)
-        percent_nans = (count_nans/total_pixels)*100
-        percent_non_nans = 100 - percent_nans
-
-        Icemask_inv = 1-Icemask
-        S2array_inv = 1-S2array
-
-        # create xarray dataset with ice mask, cloud mask and NaN mask.
-        qc_ds = xr.Dataset({'Cloudmask': (('y','x'), Cloudmask.values),'Icemask': (('y','x'), Icemask_inv),
-                            'NaNmask': (('y','x'), np.flip(S2array_inv,0))})
-
-        # good pixels are zeros in all three layers, so if the sum of the three layers is >0, that pixel is bad because of
-        # either NaN, non-ice or cloud
-        ds_sum = qc_ds.Cloudmask.values+qc_ds.Icemask.values+qc_ds.NaNmask.values
-        bad_pixels = np.count_nonzero(ds_sum)
-        good_pixels = total_pixels - bad_pixels
-        unuseable_area = (bad_pixels/total_pixels)*100
-        useable_area = (good_pixels/total_pixels)*100
-        print('good = {}%, bad = {}%'.format(useable_area,unuseable_area))
+    total_pixels = B02.size
+
+    # good pixels are ice, cloud-free and non-NaN, so a pixel is bad if it fails any one of the three tests.
+    # All four counts come from one fused pass over the masks so no intermediate boolean arrays are allocated.
+    cloud_pixels, non_ice_pixels, nan_pixels, bad_pixels = _qc_counts(np.ascontiguousarray(Icemask),
+                                                                      np.ascontiguousarray(Cloudmask),
+                                                                      B02)
+    good_pixels = total_pixels - bad_pixels
+    unuseable_area = (bad_pixels/total_pixels)*100
+    useable_area = (good_pixels/total_pixels)*100
+    print('cloud = {}%, non-ice = {}%, NaN = {}%'.format((cloud_pixels/total_pixels)*100,
+                                                         (non_ice_pixels/total_pixels)*100,
+                                                         (nan_pixels/total_pixels)*100))
+    print('good = {}%, bad = {}%'.format(useable_area,unuseable_area))
 
     # report to console
     print("{} % of the image is composed of useable pixels".format(np.round(useable_area,2)))
@@ -583,8 +621,12 @@ def create_outData(tile,year,month,savepath):
         dateList.append(i.split(str(tile+'_'))[1].split('_Class')[0])
 
     # OPEN ALL FLES INTO ONE DATASET, SAVE CONCATENATED FILE TO NETCDF
-    ds = xr.open_mfdataset(file_list,concat_dim='date',chunks={'x': 2000, 'y': 2000})
-    ds = ds.assign_coords(date=dateList)
+    # files are opened in parallel by dask and stacked in the (sorted) order given, so the date axis is monotonic
+    # and xarray does not need to inspect coordinates to work out the combine order. Concatenating along an
+    # index of the dates labels the date axis as part of the combine. The index is wrapped in a list: xarray
+    # takes concat_dim as one entry per nesting level, and would read a bare index as one dimension per date.
+    ds = xr.open_mfdataset(file_list, concat_dim=[pd.Index(dateList, name='date')], combine='nested', parallel=True,
+                           chunks={'x': 2000, 'y': 2000})
 
     ds.to_netcdf(str(outPath+'/FULL_OUTPUT_{}_{}.nc'.format(tile,year)))
     ds = None
@@ -596,6 +638,34 @@ def create_outData(tile,year,month,savepath):
     return dateList
 
 
+def class_stats(classified, values, n_classes=len(class_names)):
+    """
+    Count, mean and standard deviation of values for each surface class in classified. Uses np.bincount so each
+    statistic is one pass over the image rather than one boolean selection per class. NaNs in values propagate to
+    the mean and std of their class as they would with np.mean/np.std, and classes with no pixels give NaN.
+
+    :param classified: array of integer class labels (NaN for masked pixels)
+    :param values: array of values (e.g. albedo) with the same shape as classified
+    :param n_classes: number of classes (labels 0 to n_classes-1)
+    :return count, mean, std: arrays of length n_classes, one entry per label whether or not it occurs
+    """
+
+    classified = np.ravel(classified)
+    values = np.ravel(values)
+
+    valid = np.isin(classified, np.arange(n_classes))
+    idx = classified[valid].astype(np.intp)
+    vals = values[valid].astype(np.float64)
+
+    count = np.bincount(idx, minlength=n_classes)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(idx, weights=vals, minlength=n_classes) / count
+        std = np.sqrt(np.maximum(np.bincount(idx, weights=vals**2, minlength=n_classes) / count - mean**2, 0))
+
+    return count, mean, std
+
+
 def createSummaryData(tile,year,month, savepath,dateList, upload_to_blob = False):
 
     outPath = savepath
@@ -605,11 +675,11 @@ def createSummaryData(tile,year,month, savepath,dateList, upload_to_blob = False
     # DEFINE SIZE OF OUT ARRAYS
     if config.get('options','retrieve_disort_params')=='True':
         out = np.zeros(shape=(8,len(ds.date)))
-        outClass = np.zeros(shape=(9,len(ds.date),7))
+        outClass = np.zeros(shape=(9,len(ds.date),len(class_names)))
 
     else:
         out = np.zeros(shape=(2,len(ds.date)))
-        outClass = np.zeros(shape=(3,len(ds.date),7))
+        outClass = np.zeros(shape=(3,len(ds.date),len(class_names)))
 
 
     # START SUMMARIZING DATA AND APPENDING RESULTS TO OUT ARRAYS 
@@ -618,32 +688,32 @@ def createSummaryData(tile,year,month, savepath,dateList, upload_to_blob = False
         for i in range(len(ds.date)):
 
             date_i = dateList[i]
+
+            # read the layers needed for this date from disk once; every statistic below is then computed
+            # from memory rather than re-reading the file for each mean, std and class summary
+            day = ds[['classified', 'albedo', 'grain_size', 'density', 'algae']].sel(date=date_i).load()
+
             # scalar outputs
-            out[0,i] = ds.albedo.sel(date=date_i).mean().values  # mean albedo across whole tile
-            out[1,i] = ds.albedo.sel(date=date_i).std().values # std albedo across whole tile
-            out[2,i] = ds.grain_size.sel(date=date_i).mean().values # mean grain size
-            out[3,i] = ds.grain_size.sel(date=date_i).std().values # std grain size
-            out[4,i] = ds.density.sel(date=date_i).mean().values # mean density
-            out[5,i] = ds.density.sel(date=date_i).std().values # std density
-            out[6,i] = ds.algae.sel(date=date_i).mean().values # mean algae
-            out[7,i] = ds.algae.sel(date=date_i).std().values # mean algae
+            out[0,i] = day.albedo.mean().values  # mean albedo across whole tile
+            out[1,i] = day.albedo.std().values # std albedo across whole tile
+            out[2,i] = day.grain_size.mean().values # mean grain size
+            out[3,i] = day.grain_size.std().values # std grain size
+            out[4,i] = day.density.mean().values # mean density
+            out[5,i] = day.density.std().values # std density
+            out[6,i] = day.algae.mean().values # mean algae
+            out[7,i] = day.algae.std().values # mean algae
             
-            # outputs by class
-            for j in range(7):
-
-                outClass[0,i,j] = len(ds.classified.sel(date=date_i).values[ds.classified.sel(date=date_i).values==j]) # count instances of each class
-                outClass[1,i,j] = np.mean(ds.classified.sel(date=date_i).values[ds.classified.sel(date=date_i).values==j]) # mean of albedo in each class
-                outClass[2,i,j] = np.std(ds.classified.sel(date=date_i).values[ds.classified.sel(date=date_i).values==j]) # std of albedo in each class
-                outClass[3,i,j] = np.mean(ds.grain_size.sel(date=date_i).values[ds.classified.sel(date=date_i).values==j]) # mean of grain size in each class
-                outClass[4,i,j] = np.std(ds.grain_size.sel(date=date_i).values[ds.classified.sel(date=date_i).values==j]) # std of grain size in each class
-                outClass[5,i,j] = np.mean(ds.density.sel(date=date_i).values[ds.classified.sel(date=date_i).values==j]) # mean of density in each class
-                outClass[6,i,j] = np.std(ds.density.sel(date=date_i).values[ds.classified.sel(date=date_i).values==j]) # std of density in each class
-                outClass[7,i,j] = np.mean(ds.algae.sel(date=date_i).values[ds.classified.sel(date=date_i).values==j]) # mean of algae in each class
-                outClass[8,i,j] = np.std(ds.algae.sel(date=date_i).values[ds.classified.sel(date=date_i).values==j]) # std of algae in each class
+            # outputs by class: count, mean and std of each layer in each class
+            classified = day.classified.values
+            outClass[0,i], outClass[1,i], outClass[2,i] = class_stats(classified, day.albedo.values)
+            _, outClass[3,i], outClass[4,i] = class_stats(classified, day.grain_size.values)
+            _, outClass[5,i], outClass[6,i] = class_stats(classified, day.density.values)
+            _, outClass[7,i], outClass[8,i] = class_stats(classified, day.algae.values)
+            day = None
         
         outTileXR = xr.DataArray(out,dims=('var','date'),coords={'var':['meanAlbedo','STDAlbedo','meanGrain','STDGrain','meanDensity','STDDensity','meanAlgae','STDAlgae'],'date':dateList})
         outClassXR = xr.DataArray(outClass,dims=('var','date','classID'),coords={'var': ['ClassCount','AlbedoMean','AlbedoSTD','GrainMean','GrainSTD','DensityMean','DensitySTD','AlgaeMean','AlgaeSTD'], 'date':dateList,\
-            'classID':['NONE','SN', 'WAT', 'CC', 'CI', 'LA', 'HA']})
+            'classID':class_names})
 
         outTileXR.to_netcdf(savepath + 'OutData_{}_{}.nc'.format(tile,year))
         outClassXR.to_netcdf(savepath + 'OutData_{}_{}_byClass.nc'.format(tile,year))
@@ -653,20 +723,21 @@ def createSummaryData(tile,year,month, savepath,dateList, upload_to_blob = False
         for i in range(len(ds.date)):
             
             date_i = dateList[i]
-            # scalar outputs
-            out[0,i] = ds.albedo.sel(date=date_i).mean(skipna=True).values  # mean albedo across whole tile
-            out[1,i] = ds.albedo.sel(date=date_i).std(skipna = True).values # std albedo across whole tile
 
-            # outputs by class
-            for j in range(7):
+            # read the layers needed for this date from disk once
+            day = ds[['classified', 'albedo']].sel(date=date_i).load()
+
+            # scalar outputs
+            out[0,i] = day.albedo.mean(skipna=True).values  # mean albedo across whole tile
+            out[1,i] = day.albedo.std(skipna = True).values # std albedo across whole tile
 
-                outClass[0,i,j] = len(ds.classified.sel(date=date_i).values[ds.classified.sel(date=date_i).values==j]) # count instances of each class
-                outClass[1,i,j] = np.mean(ds.albedo.sel(date=date_i).values[ds.classified.sel(date=date_i).values==j]) # mean of albedo in each class
-                outClass[2,i,j] = np.std(ds.albedo.sel(date=date_i).values[ds.classified.sel(date=date_i).values==j]) # std of albedo in each class
+            # outputs by class: count, mean and std of albedo in each class
+            outClass[0,i], outClass[1,i], outClass[2,i] = class_stats(day.classified.values, day.albedo.values)
+            day = None
 
         outTileXR = xr.DataArray(out,dims=('var','date'),coords={'var':['meanAlbedo','STD Albedo'],'date':dateList})
         outClassXR = xr.DataArray(outClass,dims=('var','date','classID'),coords={'var': ['ClassCount','AlbedoMean','AlbedoSTD'], 'date':dateList,
-        'classID':['NONE','SN', 'WAT', 'CC', 'CI', 'LA', 'HA']})
+        'classID':class_names})
 
         outTileXR.to_netcdf(savepath + 'OutData_{}_{}.nc'.format(tile,year))
         outClassXR.to_netcdf(savepath + 'OutData_{}_{}_byClass.nc'.format(tile,year))